@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from .models import User, Message, Task
+from django.db.models import Q
+from .models import User, Message, Task, ChatReadCursor
+from .search import search_messages
 
 # Register your custom User model
 admin.site.register(User, UserAdmin)
@@ -19,10 +21,22 @@ class MessageAdmin(admin.ModelAdmin):
     list_filter = ('read', 'timestamp')  # Filters to quickly view read/unread messages
     search_fields = ('sender__username', 'content')  # Search by sender username and message content
 
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return super().get_search_results(request, queryset, search_term)
+        # Content goes through the full-text index rather than a LIKE scan
+        matches = search_messages(Message.objects.all(), search_term).values('id')
+        return queryset.filter(Q(id__in=matches) | Q(sender__username__icontains=search_term)), False
+
 admin.site.register(Message, MessageAdmin)
 
 @admin.register(Task)
 class TaskAdmin(admin.ModelAdmin):
     list_display = ('id', 'task_name', 'user', 'created_at')
     search_fields = ('task_name', 'description', 'user__username')
-    list_filter = ('created_at', 'user')
\ No newline at end of file
+    list_filter = ('created_at', 'user')
+
+@admin.register(ChatReadCursor)
+class ChatReadCursorAdmin(admin.ModelAdmin):
+    list_display = ('user', 'chat_session', 'last_read_message_id', 'updated_at')
+    search_fields = ('user__username',)
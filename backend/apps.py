@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class BackendConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'backend'
+
+    def ready(self):
+        # Connects the cache invalidation and query recording signal handlers
+        from . import caching, profiling  # noqa: F401
+        from .search import install_search_index
+        post_migrate.connect(install_search_index, sender=self)
@@ -0,0 +1,40 @@
+from urllib.parse import parse_qs
+from channels.middleware import BaseMiddleware
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+# Browsers can't set headers on WebSocket requests, so the access token comes either as
+# ?token=<jwt> or as the subprotocol pair "access_token, <jwt>".
+TOKEN_QUERY_PARAM = 'token'
+TOKEN_SUBPROTOCOL = 'access_token'
+
+
+def get_token(scope):
+    query = parse_qs(scope.get('query_string', b'').decode())
+    if TOKEN_QUERY_PARAM in query:
+        return query[TOKEN_QUERY_PARAM][0], None
+    subprotocols = scope.get('subprotocols') or []
+    if TOKEN_SUBPROTOCOL in subprotocols[:-1]:
+        return subprotocols[subprotocols.index(TOKEN_SUBPROTOCOL) + 1], TOKEN_SUBPROTOCOL
+    return None, None
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Authenticates WebSocket connections with the same access tokens as the REST API.
+    The signature and expiry are checked in memory (SIMPLE_JWT settings), without
+    touching the database. Sets scope['user_id'] to the token's user, or None.
+    """
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope, user_id=None, auth_subprotocol=None)
+        token, subprotocol = get_token(scope)
+        if token:
+            try:
+                access_token = AccessToken(token)
+                scope['user_id'] = int(access_token[api_settings.USER_ID_CLAIM])
+                scope['auth_subprotocol'] = subprotocol
+            except (TokenError, KeyError, ValueError):
+                pass
+        return await super().__call__(scope, receive, send)
@@ -0,0 +1,653 @@
+import asyncio
+import http.client
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from io import StringIO
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from .auth import JWTAuthMiddleware
+from .consumers import registry
+from .events import decode
+from .models import User, ChatSession, Message
+from .routing import websocket_urlpatterns
+from .search import search_messages
+from .utils import get_or_create_direct_session
+from .wire import DEFLATE_TRAILER, WireFormat
+
+# Benchmarks run by `manage.py bench`, each against a fresh test database.
+BENCHMARKS = {}
+
+# Password of the users created by seed_dataset
+BENCH_PASSWORD = 'bench-password'
+
+def benchmark(name):
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(durations):
+    # Durations are in seconds, reported in milliseconds
+    return {
+        'count': len(durations),
+        'mean_ms': round(statistics.mean(durations) * 1000, 4),
+        'p50_ms': round(percentile(durations, 50) * 1000, 4),
+        'p95_ms': round(percentile(durations, 95) * 1000, 4),
+        'p99_ms': round(percentile(durations, 99) * 1000, 4),
+    }
+
+def time_calls(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+def create_pair_sessions(pairs, batch_size=5000):
+    # Direct sessions for (user id, user id) pairs with bulk inserts; returns the session ids
+    Participant = ChatSession.participants.through
+    session_ids = []
+    for start in range(0, len(pairs), batch_size):
+        batch = pairs[start:start + batch_size]
+        sessions = ChatSession.objects.bulk_create(
+            [ChatSession(pair_key=ChatSession.make_pair_key(a, b)) for a, b in batch]
+        )
+        Participant.objects.bulk_create(
+            [Participant(chatsession_id=session.id, user_id=user_id)
+             for session, pair in zip(sessions, batch) for user_id in pair]
+        )
+        session_ids += [session.id for session in sessions]
+    return session_ids
+
+def seed_pair_sessions(count, batch_size=5000):
+    # Direct sessions between every pair of a pool of users, created with bulk inserts
+    user_count = 2
+    while user_count * (user_count - 1) // 2 < count:
+        user_count += 1
+    existing = User.objects.count()
+    User.objects.bulk_create(
+        [User(username=f'bench_{existing + i}') for i in range(user_count)], batch_size=batch_size
+    )
+    user_ids = list(User.objects.order_by('-id').values_list('id', flat=True)[:user_count])
+
+    pairs = [(a, b) for i, a in enumerate(user_ids) for b in user_ids[i + 1:]][:count]
+    create_pair_sessions(pairs, batch_size)
+    return pairs
+
+def seed_dataset(users, contacts, messages, seed=0, batch_size=5000):
+    """
+    Synthetic chat data for load tests: `users` users sharing one password, direct sessions
+    from each to `contacts` random others, and `messages` messages spread over the sessions.
+    Returns the user ids, the session count and one (user, contact) pair per user.
+    """
+    rng = random.Random(seed)
+    # Guest signups greet new users from this account
+    User.objects.get_or_create(id=settings.WELCOME_BOT_USER_ID, defaults={'username': 'welcome_bot'})
+    password = make_password(BENCH_PASSWORD)
+    existing = User.objects.count()
+    created = User.objects.bulk_create(
+        [User(username=f'bench_{existing + i}', password=password) for i in range(users)], batch_size=batch_size
+    )
+    user_ids = [user.id for user in created]
+
+    pair_keys = set()
+    pairs = []
+    for user_id in user_ids:
+        for contact_id in rng.sample(user_ids, min(contacts + 1, len(user_ids))):
+            pair_key = ChatSession.make_pair_key(user_id, contact_id)
+            if contact_id != user_id and pair_key not in pair_keys:
+                pair_keys.add(pair_key)
+                pairs.append((user_id, contact_id))
+    session_ids = create_pair_sessions(pairs, batch_size)
+    senders = [(session_id, user_id) for session_id, pair in zip(session_ids, pairs) for user_id in pair]
+    if senders:
+        seed_messages(senders, messages, rng, batch_size)
+
+    contact_of = {}
+    for a, b in pairs:
+        contact_of.setdefault(a, b)
+        contact_of.setdefault(b, a)
+    return {
+        'user_ids': user_ids,
+        'sessions': len(pairs),
+        'pairs': [(user_id, contact_of[user_id]) for user_id in user_ids if user_id in contact_of],
+    }
+
+@benchmark('pair_lookup')
+def bench_pair_lookup(sizes=(1000, 10000, 100000), repeat=500, **options):
+    """Cost of finding an existing direct session as the sessions table grows."""
+    results = []
+    seeded = 0
+    for size in sizes:
+        pairs = seed_pair_sessions(size - seeded)
+        seeded = size
+        user_a, user_b = pairs[len(pairs) // 2]
+
+        with CaptureQueriesContext(connection) as queries:
+            get_or_create_direct_session(user_a, user_b)
+        plan = ChatSession.objects.filter(pair_key=ChatSession.make_pair_key(user_a, user_b)).explain()
+
+        durations = time_calls(lambda: get_or_create_direct_session(user_a, user_b), repeat)
+        results.append(dict(sessions=size, queries=len(queries), plan=plan, **summarize(durations)))
+    return results
+
+def websocket_token(user_id):
+    # Access tokens are verified without a database lookup, so the user need not exist
+    token = AccessToken()
+    token[api_settings.USER_ID_CLAIM] = user_id
+    return str(token)
+
+def chat_communicator(user_id):
+    application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+    return WebsocketCommunicator(application, f"/ws/user/{user_id}/?token={websocket_token(user_id)}")
+
+async def send_chat_messages(sender_id, recipient_id, count):
+    # Sends messages one after another, timing each until the sender receives its echo
+    communicator = chat_communicator(sender_id)
+    await communicator.connect()
+    durations = []
+    for i in range(count):
+        start = time.perf_counter()
+        await communicator.send_json_to({
+            'type': 'message', 'senderId': sender_id, 'recipientId': recipient_id, 'content': f"message {i}",
+        })
+        await communicator.receive_json_from(timeout=5)
+        durations.append(time.perf_counter() - start)
+    await communicator.disconnect()
+    return durations
+
+@benchmark('message_throughput')
+def bench_message_throughput(repeat=2000, **options):
+    """Messages per second through ChatConsumer, saving each message vs write-behind batches."""
+    sender, recipient = User.objects.bulk_create([User(username='bench_sender'), User(username='bench_recipient')])
+    results = {}
+    for mode, write_behind in (('immediate', False), ('write_behind', True)):
+        Message.objects.all().delete()
+        # One socket sends far more than the per-connection rate limit allows
+        with override_settings(CHAT_WRITE_BEHIND=write_behind, CHAT_RATE_LIMITS={'default': (1e9, 1e9)}):
+            start = time.perf_counter()
+            durations = async_to_sync(send_chat_messages)(sender.id, recipient.id, repeat)
+            elapsed = time.perf_counter() - start
+        results[mode] = dict(
+            messages_per_second=round(repeat / elapsed, 1),
+            persisted=Message.objects.count(),
+            **summarize(durations)
+        )
+    return results
+
+# One frame per incoming event type, as clients send them
+SAMPLE_FRAMES = {
+    'message': {'type': 'message', 'senderId': 1, 'recipientId': 2, 'content': "See you at the gym at 6"},
+    'trainer-request-sent': {
+        'type': 'trainer-request-sent', 'id': 10, 'from_user': 1, 'to_user': 2,
+        'created_at': '2024-01-01T12:00:00Z', 'is_active': True,
+    },
+    'remove-client': {'type': 'remove-client', 'from_user': 1, 'to_user': 2},
+    'mark-read': {'type': 'mark-read', 'chat_session': 5, 'up_to': 120},
+    'heartbeat': {'type': 'heartbeat'},
+}
+
+@benchmark('dispatch')
+def bench_dispatch(repeat=100000, **options):
+    """Cost per frame of parsing, validating and resolving the handler in ChatConsumer.receive."""
+    results = {}
+    for event_type, frame in SAMPLE_FRAMES.items():
+        text = json.dumps(frame)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            payload, parsed_type = decode(text)
+            registry.resolve(parsed_type, payload)
+        elapsed = time.perf_counter() - start
+        results[event_type] = {'frames': repeat, 'us_per_frame': round(elapsed / repeat * 1e6, 3)}
+    return results
+
+def sample_outgoing_frames(count):
+    # Frames as the server sends them, varied so compression can't just repeat itself
+    rng = random.Random(0)
+    templates = [
+        lambda i, a, b: {'type': 'message', 'message': {
+            'sender': a, 'recipient': b, 'content': f"Message {i}: see you at the gym at {rng.randint(5, 21)}",
+            'timestamp': f'2024-01-01T12:{i // 60 % 60:02d}:{i % 60:02d}.{rng.randint(0, 999999):06d}+00:00',
+        }},
+        lambda i, a, b: {'type': 'trainer-request-sent', 'data': {
+            'id': i, 'from_user': a, 'to_user': b, 'created_at': '2024-01-01T12:00:00Z', 'is_active': True,
+        }},
+        lambda i, a, b: {'type': 'read_receipt', 'data': {'user': a, 'chat_session': b, 'last_read_message_id': i}},
+        lambda i, a, b: {'type': 'presence', 'data': {'user': a, 'online': bool(i % 2)}},
+        lambda i, a, b: {'type': 'remove_client', 'data': {'from_user': a, 'to_user': b}},
+    ]
+    return [
+        json.dumps({'seq': i + 1, **templates[i % len(templates)](i, rng.randint(1, 100000), rng.randint(1, 100000))})
+        for i in range(count)
+    ]
+
+@benchmark('wire_formats')
+def bench_wire_formats(repeat=20000, **options):
+    """Bytes per frame and encode/decode cost of each WebSocket wire format."""
+    texts = sample_outgoing_frames(repeat)
+    results = {}
+    for name, deflate in (('json', False), ('json', True), ('msgpack', False), ('msgpack', True)):
+        server, client = WireFormat(name, deflate), WireFormat(name, deflate)
+        start = time.perf_counter()
+        encoded = [server.encode(text) for text in texts]
+        encode_elapsed = time.perf_counter() - start
+        frames = [kwargs['text_data'].encode() if 'text_data' in kwargs else kwargs['bytes_data'] for kwargs in encoded]
+
+        start = time.perf_counter()
+        for data in frames:
+            if deflate:
+                # The client's inflater mirrors the server's stream
+                data = client.decompressor.decompress(data + DEFLATE_TRAILER)
+            client.loads(data)
+        decode_elapsed = time.perf_counter() - start
+
+        results[server.subprotocol] = {
+            'bytes_per_frame': round(sum(map(len, frames)) / repeat, 1),
+            'encode_us_per_frame': round(encode_elapsed / repeat * 1e6, 3),
+            'decode_us_per_frame': round(decode_elapsed / repeat * 1e6, 3),
+        }
+    return results
+
+def seed_messages(sessions, count, rng, batch_size=5000):
+    # Messages of 5-15 words from a 5000 word vocabulary, a few words far more common than
+    # the rest, spread over the given (session id, sender id) pairs
+    vocabulary = [f'word{i}' for i in range(5000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    for start in range(0, count, batch_size):
+        Message.objects.bulk_create([
+            Message(
+                chat_session_id=session_id, sender_id=sender_id,
+                content=' '.join(rng.choices(vocabulary, weights, k=rng.randint(5, 15))),
+            )
+            for session_id, sender_id in rng.choices(sessions, k=min(batch_size, count - start))
+        ])
+
+@benchmark('message_search')
+def bench_message_search(sizes=(10000, 100000, 1000000), repeat=20, **options):
+    """Latency of /messages/search/'s query against a LIKE scan as the messages table grows."""
+    rng = random.Random(0)
+    pairs = seed_pair_sessions(100)
+    user_id = pairs[0][0]
+    sessions = list(ChatSession.objects.values_list('id', 'participants'))
+    scoped = Message.objects.filter(chat_session__participants=user_id)
+    # A common word, a rare one, and two words that must both appear
+    queries = ('word0', 'word4000', 'word2 word30')
+    results = []
+    seeded = 0
+    for size in sizes:
+        seed_messages(sessions, size - seeded, rng)
+        seeded = size
+        for text in queries:
+            full_text = lambda: list(search_messages(scoped, text)[:50])
+            like = scoped.order_by('-timestamp')
+            for term in text.split():
+                like = like.filter(content__icontains=term)
+            results.append({
+                'messages': size,
+                'query': text,
+                'matches': search_messages(scoped, text).count(),
+                'full_text': summarize(time_calls(full_text, repeat)),
+                'icontains': summarize(time_calls(lambda: list(like[:50]), repeat)),
+            })
+    return results
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+@contextmanager
+def redis_server():
+    # Uses REDIS_URL when configured, otherwise an in-process fakeredis server
+    if settings.REDIS_URL:
+        yield settings.REDIS_URL
+        return
+    from fakeredis import TcpFakeServer
+    port = free_port()
+    server = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"redis://127.0.0.1:{port}/0"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+@contextmanager
+def worker_database(env=None):
+    # A throwaway SQLite file with the schema, shared by worker processes
+    with tempfile.TemporaryDirectory() as directory:
+        env = {**os.environ, **(env or {}), 'SQLITE_PATH': os.path.join(directory, 'bench.sqlite3')}
+        subprocess.run(
+            [sys.executable, 'manage.py', 'migrate', '--run-syncdb', '--verbosity', '0'],
+            cwd=settings.BASE_DIR, env=env, check=True,
+        )
+        yield env['SQLITE_PATH']
+
+@contextmanager
+def daphne_workers(count, env=None):
+    # Real Daphne processes serving on_my_way.asgi, one port each
+    ports = [free_port() for _ in range(count)]
+    processes = [
+        subprocess.Popen(
+            [sys.executable, '-m', 'daphne', '-b', '127.0.0.1', '-p', str(port), 'on_my_way.asgi:application'],
+            cwd=settings.BASE_DIR, env={**os.environ, **(env or {})},
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        for port in ports
+    ]
+    try:
+        for port in ports:
+            wait_for_port(port)
+        yield ports
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+
+@benchmark('concurrent_writes')
+def bench_concurrent_writes(sizes=(1, 4, 8), repeat=5, **options):
+    """Message inserts per second and lock errors with concurrent writer processes on SQLite."""
+    results = {}
+    for profile, tuned in (('sqlite_defaults', '0'), ('sqlite_tuned', '1')):
+        results[profile] = []
+        for processes in sizes:
+            with worker_database({'SQLITE_TUNED': tuned}) as database:
+                env = {**os.environ, 'SQLITE_TUNED': tuned, 'SQLITE_PATH': database}
+                command = [
+                    sys.executable, 'manage.py', 'stress_message_writes', '--threads', '2', '--seconds', str(repeat),
+                ]
+                workers = [
+                    subprocess.Popen(command, cwd=settings.BASE_DIR, env=env, stdout=subprocess.PIPE, text=True)
+                    for _ in range(processes)
+                ]
+                outputs = [json.loads(worker.communicate()[0]) for worker in workers]
+            inserted = sum(output['inserted'] for output in outputs)
+            results[profile].append({
+                'writers': processes * 2,
+                'messages_per_second': round(inserted / repeat, 1),
+                'lock_errors': sum(output['lock_errors'] for output in outputs),
+            })
+    return results
+
+async def measure_fanout(sender_url, recipient_url, sender_id, recipient_id, count):
+    # Relays trainer requests from one socket to another, timing each delivery
+    import websockets
+    async with websockets.connect(recipient_url) as recipient, websockets.connect(sender_url) as sender:
+        durations = []
+        for i in range(count):
+            start = time.perf_counter()
+            await sender.send(json.dumps({
+                'type': 'trainer-request-sent', 'id': i, 'from_user': sender_id, 'to_user': recipient_id,
+                'created_at': '', 'is_active': True,
+            }))
+            await asyncio.wait_for(recipient.recv(), 5)
+            durations.append(time.perf_counter() - start)
+    return durations
+
+@benchmark('fanout')
+def bench_fanout(repeat=500, **options):
+    """Latency of a frame sent to Daphne worker A and delivered to a socket on worker B."""
+    results = {}
+    # fakeredis stalls on the blocking pops the core Redis layer relies on, so only the
+    # pub/sub layer is measured against it
+    layers = ('redis', 'redis-pubsub') if settings.REDIS_URL else ('redis-pubsub',)
+    with redis_server() as redis_url, worker_database() as database:
+        for layer in layers:
+            env = {'REDIS_URL': redis_url, 'CHANNEL_LAYER': layer, 'SQLITE_PATH': database}
+            with daphne_workers(2, env=env) as (port_a, port_b):
+                durations = async_to_sync(measure_fanout)(
+                    f"ws://127.0.0.1:{port_a}/ws/user/1/?token={websocket_token(1)}",
+                    f"ws://127.0.0.1:{port_b}/ws/user/2/?token={websocket_token(2)}",
+                    1, 2, repeat
+                )
+            results[layer] = summarize(durations)
+    return results
+
+# Load tests of the hot paths against seeded data, in-process and on real Daphne workers.
+# `manage.py bench --save-baseline` stores their figures and `--baseline` fails on regressions.
+
+def run_seed_command(env=None, **options):
+    # seed_chat_data in-process, or in a subprocess when env points it at a worker database
+    args = [f"--{name}={value}" for name, value in options.items()]
+    if env is None:
+        output = StringIO()
+        call_command('seed_chat_data', *args, stdout=output)
+        return json.loads(output.getvalue())
+    process = subprocess.run(
+        [sys.executable, 'manage.py', 'seed_chat_data', *args],
+        cwd=settings.BASE_DIR, env={**os.environ, **env}, check=True, capture_output=True, text=True,
+    )
+    return json.loads(process.stdout)
+
+def allowed_host():
+    # A Host header the project accepts
+    host = settings.ALLOWED_HOSTS[0] if settings.ALLOWED_HOSTS else 'localhost'
+    return 'localhost' if host == '*' else host.lstrip('.')
+
+def rest_requests(user_id, contact_id):
+    # (name, method, path, headers) of the REST hot paths for one user
+    headers = {'Authorization': f"Bearer {websocket_token(user_id)}", 'Host': allowed_host()}
+    return [
+        ('user_chats', 'GET', reverse('user_chats'), headers),
+        ('chat_history', 'GET', reverse('chat-session', kwargs={'other_user_id': contact_id}), headers),
+        ('guest_create', 'POST', reverse('create_guest_user'), {'Host': allowed_host()}),
+    ]
+
+def throughput(count, seconds, unit='requests'):
+    return {f'{unit}_per_second': round(count / seconds, 1) if seconds else None}
+
+@benchmark('rest_endpoints')
+def bench_rest_endpoints(sizes=(1000,), repeat=200, **options):
+    """Latency of /user_chats/, /chat/<id>/ and /api/guest/create/ through every middleware and JWT auth, by users seeded."""
+    results = []
+    seeded = 0
+    for users in sizes:
+        dataset = run_seed_command(users=users - seeded, messages=(users - seeded) * 20)
+        seeded = users
+        client = Client()
+        for name, method, path, headers in rest_requests(*dataset['pairs'][0]):
+            request = lambda: getattr(client, method.lower())(path, headers=headers)
+            status_code = request().status_code
+            if status_code >= 400:
+                raise RuntimeError(f"{method} {path} answered {status_code}")
+            durations = time_calls(request, repeat)
+            results.append(
+                dict(users=users, endpoint=name, **throughput(repeat, sum(durations)), **summarize(durations))
+            )
+    return results
+
+def http_client(port, requests, barrier):
+    # Sends (method, path, headers) requests one after another over one keep-alive connection
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    durations = []
+    errors = 0
+    barrier.wait()
+    for method, path, headers in requests:
+        start = time.perf_counter()
+        conn.request(method, path, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        durations.append(time.perf_counter() - start)
+        errors += response.status >= 400
+    conn.close()
+    return durations, errors
+
+def run_http_clients(port, client_requests):
+    # One thread per client, all let go at once; returns the latencies, errors and wall time
+    barrier = threading.Barrier(len(client_requests) + 1)
+    with ThreadPoolExecutor(len(client_requests)) as pool:
+        futures = [pool.submit(http_client, port, requests, barrier) for requests in client_requests]
+        barrier.wait()
+        start = time.perf_counter()
+        outputs = [future.result() for future in futures]
+        elapsed = time.perf_counter() - start
+    durations = [duration for client_durations, _ in outputs for duration in client_durations]
+    return durations, sum(errors for _, errors in outputs), elapsed
+
+@benchmark('http_load')
+def bench_http_load(sizes=(1, 8, 32), repeat=50, **options):
+    """Throughput and latency of the REST hot paths on a Daphne worker, by concurrent clients (each its own user)."""
+    results = []
+    with worker_database() as database:
+        env = {'SQLITE_PATH': database}
+        dataset = run_seed_command(env, users=max(1000, max(sizes)), messages=20000)
+        with daphne_workers(1, env=env) as (port,):
+            for clients in sizes:
+                per_client = [rest_requests(*pair) for pair in dataset['pairs'][:clients]]
+                for index, (name, *_) in enumerate(per_client[0]):
+                    durations, errors, elapsed = run_http_clients(
+                        port, [[tuple(requests[index][1:])] * repeat for requests in per_client]
+                    )
+                    results.append(dict(
+                        clients=clients, endpoint=name, errors=errors, **throughput(len(durations), elapsed),
+                        **summarize(durations)
+                    ))
+    return results
+
+async def chat_client(send, receive, user_id, partner_id, count):
+    # Sends count messages to partner_id, each once the previous one's echo is back, timing
+    # the round trips. Returns the durations and how many messages were rate limited.
+    durations = []
+    throttled = 0
+    for i in range(count):
+        content = f"{user_id}:{i}"
+        start = time.perf_counter()
+        await send({'type': 'message', 'recipientId': partner_id, 'content': content})
+        while True:
+            try:
+                frame = await receive()
+            except asyncio.TimeoutError:
+                raise RuntimeError(f"User {user_id} got no echo of message {i} within 30s")
+            if frame.get('type') == 'error' and frame.get('code') == 'rate_limited':
+                throttled += 1
+                break
+            if frame.get('type') == 'message' and frame['message']['content'] == content:
+                durations.append(time.perf_counter() - start)
+                break
+    return durations, throttled
+
+async def run_communicator_clients(pairs, count):
+    communicators = [chat_communicator(user_id) for user_id, _ in pairs]
+    await asyncio.gather(*(communicator.connect() for communicator in communicators))
+    start = time.perf_counter()
+    outputs = await asyncio.gather(*(
+        chat_client(communicator.send_json_to, lambda c=communicator: c.receive_json_from(timeout=30), *pair, count)
+        for communicator, pair in zip(communicators, pairs)
+    ))
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+    return outputs, elapsed
+
+async def run_daphne_clients(port, pairs, count):
+    import websockets
+    sockets = await asyncio.gather(*(
+        websockets.connect(f"ws://127.0.0.1:{port}/ws/user/{user_id}/?token={websocket_token(user_id)}")
+        for user_id, _ in pairs
+    ))
+
+    async def receive(socket):
+        return json.loads(await asyncio.wait_for(socket.recv(), 30))
+
+    start = time.perf_counter()
+    outputs = await asyncio.gather(*(
+        chat_client(lambda frame, s=socket: s.send(json.dumps(frame)), lambda s=socket: receive(s), *pair, count)
+        for socket, pair in zip(sockets, pairs)
+    ))
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*(socket.close() for socket in sockets))
+    return outputs, elapsed
+
+def ws_result(clients, outputs, elapsed):
+    durations = [duration for client_durations, _ in outputs for duration in client_durations]
+    return dict(
+        clients=clients, throttled=sum(throttled for _, throttled in outputs),
+        **throughput(len(durations), elapsed, 'messages'), **summarize(durations)
+    )
+
+@benchmark('ws_clients')
+def bench_ws_clients(sizes=(10, 50, 100), repeat=20, **options):
+    """
+    Chat message round trips with many clients at once, by number of clients: in-process
+    through WebsocketCommunicator and over the network to a Daphne worker. Each client sends
+    `repeat` messages, which stays within the 'message' rate limit's burst by default.
+    """
+    users = max(sizes)
+    dataset = run_seed_command(users=users, contacts=5, messages=users * 10)
+    results = {'communicator': []}
+    for clients in sizes:
+        outputs, elapsed = async_to_sync(run_communicator_clients)(dataset['pairs'][:clients], repeat)
+        results['communicator'].append(ws_result(clients, outputs, elapsed))
+
+    results['daphne'] = []
+    with worker_database() as database:
+        env = {'SQLITE_PATH': database}
+        dataset = run_seed_command(env, users=users, contacts=5, messages=users * 10)
+        with daphne_workers(1, env=env) as (port,):
+            for clients in sizes:
+                outputs, elapsed = async_to_sync(run_daphne_clients)(port, dataset['pairs'][:clients], repeat)
+                results['daphne'].append(ws_result(clients, outputs, elapsed))
+    return results
+
+# Figures compared with the baseline: latency percentiles (higher is worse) and anything
+# ending in _per_second (lower is worse)
+BASELINE_LATENCY_KEYS = ('p50_ms', 'p95_ms')
+
+def compare_results(results, baseline, tolerance, path=''):
+    # Regressions of results against baseline by more than the tolerance (a fraction), as
+    # descriptions; figures only one side has are skipped
+    if isinstance(results, dict) and isinstance(baseline, dict):
+        return [
+            regression for key in sorted(results.keys() & baseline.keys())
+            for regression in compare_results(results[key], baseline[key], tolerance, f"{path}.{key}" if path else key)
+        ]
+    if isinstance(results, list) and isinstance(baseline, list):
+        return [
+            regression for index, (result, base) in enumerate(zip(results, baseline))
+            for regression in compare_results(result, base, tolerance, f"{path}[{index}]")
+        ]
+    if isinstance(results, bool) or not isinstance(results, (int, float)) or not isinstance(baseline, (int, float)):
+        return []
+    key = path.rsplit('.', 1)[-1]
+    if key in BASELINE_LATENCY_KEYS and results > baseline * (1 + tolerance):
+        return [f"{path}: {baseline} -> {results} ms"]
+    if key.endswith('_per_second') and results < baseline * (1 - tolerance):
+        return [f"{path}: {baseline} -> {results} per second"]
+    return []
@@ -0,0 +1,154 @@
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from . import metrics
+from .models import User, ChatSession, Message
+
+# Compact user profiles and chat session member ids, read through Django's cache (local
+# memory by default, Redis when REDIS_URL is set). Entries are dropped when the row
+# changes, again once the transaction commits so a concurrent read can't put the old
+# value back, and expire after PROFILE_CACHE_TTL seconds regardless.
+
+Participant = ChatSession.participants.through
+
+def profile_key(user_id):
+    return f"profile:{user_id}"
+
+def members_key(chat_session_id):
+    return f"members:{chat_session_id}"
+
+def user_profile(user):
+    return {
+        'id': user.id,
+        'username': user.username,
+        'profile_picture': default_storage.url(user.profile_picture.name) if user.profile_picture else None,
+        'thumbnail': user.profile_picture_thumbnail(),
+    }
+
+def read_through(name, keys, load):
+    # keys maps cache keys to ids; load(missing ids) returns {id: value} from the database
+    found = cache.get_many(keys)
+    if found:
+        metrics.increment('cache_requests_total', len(found), cache=name, result='hit')
+    values = {keys[key]: value for key, value in found.items()}
+    missing = [item_id for key, item_id in keys.items() if key not in found]
+    if missing:
+        metrics.increment('cache_requests_total', len(missing), cache=name, result='miss')
+        loaded = load(missing)
+        cache.set_many(
+            {key: loaded[item_id] for key, item_id in keys.items() if item_id in loaded}, settings.PROFILE_CACHE_TTL
+        )
+        values.update(loaded)
+    return values
+
+def get_profiles(user_ids):
+    # {user_id: profile} for the given ids, in one cache round trip plus one query for misses
+    def load(missing):
+        users = User.objects.filter(id__in=missing).only('id', 'username', 'profile_picture')
+        return {user.id: user_profile(user) for user in users}
+    return read_through('profile', {profile_key(user_id): int(user_id) for user_id in user_ids}, load)
+
+def get_member_ids(chat_session_ids):
+    # {chat_session_id: [user ids]} for the given sessions
+    def load(missing):
+        members = {chat_session_id: [] for chat_session_id in missing}
+        rows = Participant.objects.filter(chatsession_id__in=missing).values_list('chatsession_id', 'user_id')
+        for chat_session_id, user_id in rows:
+            members[chat_session_id].append(user_id)
+        return members
+    return read_through('members', {members_key(session_id): int(session_id) for session_id in chat_session_ids}, load)
+
+def get_session_profiles(chat_session_ids):
+    # {chat_session_id: [participant profiles]}
+    members = get_member_ids(chat_session_ids)
+    profiles = get_profiles({user_id for user_ids in members.values() for user_id in user_ids})
+    return {
+        chat_session_id: [profiles[user_id] for user_id in user_ids if user_id in profiles]
+        for chat_session_id, user_ids in members.items()
+    }
+
+# Version stamps for conditional GETs (ETags): nanosecond times, bumped whenever a
+# chat's history or a user's inbox may have changed. A missing stamp is recreated as
+# "now", which only costs clients one full response.
+
+def inbox_version_key(user_id):
+    return f"inbox_version:{user_id}"
+
+def chat_version_key(chat_session_id):
+    return f"chat_version:{chat_session_id}"
+
+def get_version(key):
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), settings.PROFILE_CACHE_TTL)
+        version = cache.get(key) or time.time_ns()
+    return version
+
+def bump_versions(chat_session_ids=(), user_ids=()):
+    # New versions for the sessions' histories and their members' inboxes (plus user_ids'
+    # inboxes), now and again on commit: a request served in between saw the old data
+    # and must not keep the new stamp.
+    members = get_member_ids(chat_session_ids) if chat_session_ids else {}
+    user_ids = set(user_ids).union(*members.values())
+    keys = [chat_version_key(chat_session_id) for chat_session_id in chat_session_ids]
+    keys += [inbox_version_key(user_id) for user_id in user_ids]
+    if not keys:
+        return
+    def bump():
+        now = time.time_ns()
+        cache.set_many({key: now for key in keys}, settings.PROFILE_CACHE_TTL)
+    bump()
+    transaction.on_commit(bump)
+
+def invalidate(keys):
+    if keys:
+        cache.delete_many(keys)
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_profile(sender, instance, update_fields=None, **kwargs):
+    invalidate([profile_key(instance.pk)])
+    if kwargs.get('created') or (update_fields is not None and not {'username', 'profile_picture'} & set(update_fields)):
+        return
+    # The profile shows up in the inboxes of everyone the user chats with
+    bump_versions(Participant.objects.filter(user_id=instance.pk).values_list('chatsession_id', flat=True))
+
+@receiver(pre_delete, sender=User)
+def invalidate_deleted_user_memberships(sender, instance, **kwargs):
+    # The user's participant rows go with it, without m2m_changed
+    session_ids = list(Participant.objects.filter(user_id=instance.pk).values_list('chatsession_id', flat=True))
+    bump_versions(session_ids)
+    invalidate([members_key(session_id) for session_id in session_ids])
+
+@receiver(pre_delete, sender=ChatSession)
+def bump_deleted_session(sender, instance, **kwargs):
+    bump_versions([instance.pk])
+
+@receiver(post_delete, sender=ChatSession)
+def invalidate_deleted_session(sender, instance, **kwargs):
+    invalidate([members_key(instance.pk)])
+
+@receiver(m2m_changed, sender=Participant)
+def invalidate_members(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        session_ids, user_ids = [instance.pk], pk_set or ()
+    elif action == 'pre_clear':
+        # user.chats.clear(): pk_set is not given, so look the sessions up before they go
+        session_ids, user_ids = list(instance.chats.values_list('id', flat=True)), [instance.pk]
+    else:
+        session_ids, user_ids = pk_set, [instance.pk]
+    # Removed members are no longer in the member sets, so their inboxes are named too
+    bump_versions(session_ids, user_ids)
+    invalidate([members_key(session_id) for session_id in session_ids])
+
+@receiver(post_save, sender=Message)
+def bump_message_session(sender, instance, **kwargs):
+    bump_versions([instance.chat_session_id])
@@ -1,194 +1,271 @@
+import asyncio
 import json
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from .models import Message, ChatSession, User
-from django.db import models
+from django.conf import settings
+from . import metrics, presence
+from .events import EventRegistry, FrameError, boolean, decode, integer, optional, string
+from .layers import send_to_users, with_seq
+from .models import User, ChatSession, Message
+from .presence import presence_frame
+from .profiling import ProfiledConsumerMixin, name_profile
+from .throttling import RateLimiter, SendQueue
+from .utils import (get_or_create_direct_session, save_direct_message, message_frame, mark_session_read,
+read_receipt_frame, get_contact_ids, append_user_events, get_event_seq, get_missed_events)
+from .wire import negotiate
+from .writer import message_writer
 
+# Incoming event types with their payload schemas and handlers, declared in ChatConsumer
+registry = EventRegistry()
 
-class ChatConsumer(AsyncWebsocketConsumer):
+# Close code sent to clients that read too slowly under the 'disconnect' send queue policy
+SLOW_CONSUMER_CLOSE_CODE = 4008
+# Close code for a compressed frame that can't be inflated (RFC 6455 "invalid frame payload data")
+INVALID_PAYLOAD_CLOSE_CODE = 1007
+
+
+class ChatConsumer(ProfiledConsumerMixin, AsyncWebsocketConsumer):
     async def connect(self):
-        self.user_id = self.scope['url_route']['kwargs']['user_id']
+        # JWTAuthMiddleware puts the authenticated user in the scope; the URL must name that user
+        self.user_id = self.scope.get('user_id')
         self.personal_channel_name = f"user_{self.user_id}"
+        if self.user_id is None or str(self.user_id) != self.scope['url_route']['kwargs']['user_id']:
+            await self.close()
+            return
 
         # Subscribe to personal channel
         await self.channel_layer.group_add(
             self.personal_channel_name,
             self.channel_name
         )
-        await self.accept()
+        # Chat session ids already resolved on this connection, keyed by pair key
+        self.chat_session_ids = {}
+        self.rate_limiter = RateLimiter(settings.CHAT_RATE_LIMITS)
+        # Outgoing frames are written by one task from a bounded queue, so a slow client
+        # can't make frames pile up without limit
+        self.send_queue = SendQueue(settings.CHAT_SEND_QUEUE_SIZE, settings.CHAT_SEND_QUEUE_POLICY)
+        self.send_task = asyncio.create_task(self.drain_send_queue())
+        self.wire, wire_subprotocol = negotiate(self.scope)
+        await self.accept(subprotocol=self.scope.get('auth_subprotocol') or wire_subprotocol)
+
+        # Highest event seq sent by replay_events; live frames up to it are duplicates
+        self.replayed_up_to = 0
+        # Highest seq the client has; an evicted presence entry is caught up from here
+        self.delivered_seq = 0
+        self.registered = True
+        if await sync_to_async(presence.register, thread_sensitive=False)(self.user_id):
+            await self.announce_presence(True)
+        self.presence_task = asyncio.create_task(self.keep_presence())
+
+        last_seq = parse_qs(self.scope.get('query_string', b'').decode()).get('last_seq')
+        if last_seq and last_seq[0].isdigit():
+            await self.replay_events(int(last_seq[0]))
+        else:
+            # A client without last_seq loads its state over REST; nothing logged so far is missing
+            self.delivered_seq = await database_sync_to_async(get_event_seq)(self.user_id)
 
     async def disconnect(self, close_code):
+        if settings.CHAT_WRITE_BEHIND:
+            await message_writer.flush()
+
+        if getattr(self, 'presence_task', None):
+            self.presence_task.cancel()
+        if getattr(self, 'registered', False):
+            if await sync_to_async(presence.unregister, thread_sensitive=False)(self.user_id):
+                await self.announce_presence(False)
+
         # Unsubscribe from personal channel
         await self.channel_layer.group_discard(
             self.personal_channel_name,
             self.channel_name
         )
+        if getattr(self, 'send_task', None):
+            self.send_task.cancel()
 
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        event_type = text_data_json.get('type')
-
-        # Dispatch to the appropriate handler based on the type of the message
-        if event_type == 'message':
-            await self.handle_chat_message(text_data_json)
-        elif event_type == 'trainer-request-sent':
-            await self.handle_trainer_request(text_data_json)
-        elif event_type == 'trainer-request-accepted':
-            await self.handle_accepted_response(text_data_json)
-        elif event_type == 'trainer-rejected-accepted':
-            await self.handle_rejected_response(text_data_json)
-        elif event_type == 'remove-client':
-            await self.handle_remove_client(text_data_json)
-        elif event_type == 'remove-trainer':
-            await self.handle_remove_trainer(text_data_json)
+    async def receive(self, text_data=None, bytes_data=None):
+        data = text_data if text_data is not None else bytes_data
+        if len(data) > settings.CHAT_MAX_FRAME_BYTES:
+            metrics.increment('ws_frames_dropped_total', reason='too_large')
+            self.send_error('frame_too_large')
+            return
 
+        if bytes_data is not None and self.wire.deflate:
+            try:
+                data = self.wire.inflate(data, settings.CHAT_MAX_FRAME_BYTES)
+            except FrameError as e:
+                # The compressed stream can't be resumed after a bad frame
+                metrics.increment('ws_frames_rejected_total', reason=e.code)
+                await self.close(code=INVALID_PAYLOAD_CLOSE_CODE)
+                return
+
+        event_type = None
+        try:
+            payload, event_type = decode(data, self.wire.loads)
+
+            if not self.rate_limiter.allow(event_type):
+                # Labelled by bucket, as the type is whatever string the client sent
+                metrics.increment('ws_frames_throttled_total', bucket=self.rate_limiter.bucket_key(event_type))
+                self.send_error('rate_limited', event=event_type)
+                return
+
+            # The sender is always the authenticated user; refuse frames claiming to be someone else
+            claimed_sender = payload.get('senderId', payload.get('from_user'))
+            if claimed_sender is not None and str(claimed_sender) != str(self.user_id):
+                raise FrameError('forbidden_sender')
+
+            handler, data = registry.resolve(event_type, payload)
+            name_profile(event_type)
+            await handler(self, data)
+        except FrameError as e:
+            metrics.increment('ws_frames_rejected_total', reason=e.code)
+            self.send_error(e.code, event=event_type, **e.details)
+
+    @registry.handler('message', recipientId=integer, content=string)
     async def handle_chat_message(self, data):
-        # Prepare and send message to both the sender's and recipient's personal channel
-        message_data = {
-            'type': 'chat_message',
-            'message': {
-                'sender': data['senderId'],
-                'recipient': data['recipientId'],
-                'content': data['content'],
-            },
-        }
-        # Save the message
-        await self.save_message(data['senderId'],  data['recipientId'], data['content'])
-
-        await self.channel_layer.group_send(f"user_{data['senderId']}", message_data)
-        await self.channel_layer.group_send(f"user_{data['recipientId']}", message_data)
-
-    async def handle_trainer_request(self, data):
-        # Directly relay the trainer request data to the recipient's channel
-        request_data = {
-            'type': 'forward_trainer_request',
-            'request': {
-                'id': data['id'],
-                'from_user': data['from_user'],
-                'to_user': data['to_user'],
-                'created_at': data['created_at'],
-                'is_active': data['is_active']
-            },
-        }
-        await self.channel_layer.group_send(f"user_{data['to_user']}", request_data)
-
-    async def handle_accepted_response(self, data):
-        # Process trainer request responses (accepted or rejected)
-        response_data = {
-            'type': 'forward_request_accepted',  # This will be either 'trainer-request-accepted' or 'trainer-request-rejected'
-            'data': {
-                'id': data['id'],
-                'from_user': data['from_user'],
-                'to_user': data['to_user']
-            }
-        }
-        await self.channel_layer.group_send(f"user_{data['to_user']}", response_data)
-
-    async def handle_rejected_response(self, data):
-        # Process trainer request responses (accepted or rejected)
-        response_data = {
-            'type': 'forward_request_rejected',  # This will be either 'trainer-request-accepted' or 'trainer-request-rejected'
-            'data': {
-                'id': data['id'],
-                'from_user': data['from_user'],
-                'to_user': data['to_user']
-            }
-        }
-        await self.channel_layer.group_send(f"user_{data['to_user']}", response_data)
-
-    async def handle_remove_client(self, data):
-        response_data = {
-            'type': 'forward_remove_client',
-            'data': {
-                'from_user': data['from_user'],
-                'to_user': data['to_user']
-            }
-        }
-        await self.channel_layer.group_send(f"user_{data['to_user']}", response_data)
-
-    async def handle_remove_trainer(self, data):
-        response_data = {
-            'type': 'forward_remove_trainer', 
-            'data': {
-                'from_user': data['from_user'],
-                'to_user': data['to_user']
-            }
-        }
-        await self.channel_layer.group_send(f"user_{data['to_user']}", response_data)
-
-    async def chat_message(self, event):
-        # Send chat message data to the WebSocket client
-        await self.send(text_data=json.dumps({
-            'type': 'message',
-            'message': event['message']
-        }))
-    
-    async def forward_trainer_request(self, event):
-        # Forward the trainer request data to the WebSocket client
-        await self.send(text_data=json.dumps({
-            'type': 'trainer-request-sent',
-            'data': event['request']
-        }))
-
-    async def forward_request_accepted(self, event):
-        # Handler for when a trainer request is accepted
-        await self.send(text_data=json.dumps({
-            'type': 'trainer_request_accepted',
-            'data': event['data']
-        }))
-
-    async def forward_request_rejected(self, event):
-        # Handler for when a trainer request is rejected
-        await self.send(text_data=json.dumps({
-            'type': 'trainer_request_rejected',
-            'data': event['data']
-        }))
-
-    async def forward_remove_client(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'remove_client',
-            'data': event['data']
-        }))
-
-    async def forward_remove_trainer(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'remove_trainer',
-            'data': event['data']
-        }))
-
-    @database_sync_to_async
-    def get_or_create_chat_session(self, user_id_1, user_id_2):
-        # Ensure the user IDs are in a consistent order
-        user_id_1, user_id_2 = sorted([user_id_1, user_id_2])
-
-        # Retrieve users from the database
-        user1, user2 = User.objects.get(id=user_id_1), User.objects.get(id=user_id_2)
-
-        # Check for an existing chat session between these two users
-        chat_sessions = ChatSession.objects.filter(
-            participants__id__in=[user1.id, user2.id]
-        ).annotate(participants_count=models.Count('participants')).filter(participants_count=2)
-
-        if chat_sessions.exists():
-            return chat_sessions.first(), False
+        # Send the message to both the sender's and recipient's personal channel
+        user_ids = [self.user_id, data['recipientId']]
+        try:
+            if settings.CHAT_WRITE_BEHIND:
+                # Queue the message for the background writer and broadcast right away. The
+                # frame has the message's uuid but no id or seq yet; the writer logs it with
+                # both (see CHAT_WRITE_BEHIND in settings).
+                message = await self.queue_message(self.user_id, data['recipientId'], data['content'])
+                await self.send_frame(user_ids, message_frame(message, data['recipientId']), log=False)
+            else:
+                # Saved and logged in the users' event streams in one transaction
+                message = await self.save_message(self.user_id, data['recipientId'], data['content'])
+                await self.deliver(
+                    user_ids, message_frame(message, data['recipientId']), message.frame_text, seqs=message.seqs
+                )
+        except User.DoesNotExist:
+            raise FrameError('unknown_user', field='recipientId')
+
+    # Relayed to the to_user as {'type': <outgoing type>, 'data': {...declared fields, from_user}}
+    registry.relay('trainer-request-sent', 'trainer-request-sent', id=integer, created_at=string, is_active=boolean)
+    registry.relay('trainer-request-accepted', 'trainer_request_accepted', id=integer)
+    registry.relay('trainer-rejected-accepted', 'trainer_request_rejected', id=integer)
+    registry.relay('remove-client', 'remove_client')
+    registry.relay('remove-trainer', 'remove_trainer')
+
+    @registry.handler('mark-read', chat_session=integer, up_to=optional(integer))
+    async def handle_mark_read(self, data):
+        try:
+            last_read_message_id, participant_ids = await database_sync_to_async(mark_session_read)(
+                self.user_id, data['chat_session'], data.get('up_to')
+            )
+        except ChatSession.DoesNotExist:
+            # Unknown, or not one of the user's sessions; REST answers 404
+            raise FrameError('unknown_session', field='chat_session')
+        # Tell the other participants, and the user's other devices
+        await self.send_frame(
+            participant_ids, read_receipt_frame(self.user_id, data['chat_session'], last_read_message_id),
+            coalesce_key=f"read:{data['chat_session']}:{self.user_id}",
+        )
+
+    @registry.handler('heartbeat')
+    async def handle_heartbeat(self, data):
+        # keep_presence already refreshes the entry; this answers clients that still send heartbeats
+        await self.refresh_presence()
+
+    async def keep_presence(self):
+        # Refreshes the user's presence entry for as long as this connection is open
+        while True:
+            await asyncio.sleep(settings.PRESENCE_TTL / 2)
+            await self.refresh_presence()
+
+    async def refresh_presence(self):
+        if await sync_to_async(presence.refresh, thread_sensitive=False)(self.user_id):
+            # The entry was gone (evicted), so frames may have skipped this connection
+            await self.replay_events(self.delivered_seq)
+            await self.announce_presence(True)
+
+    async def announce_presence(self, online):
+        contact_ids = await database_sync_to_async(get_contact_ids)(self.user_id)
+        await self.send_frame(
+            contact_ids, presence_frame(self.user_id, online), notify_offline=False,
+            coalesce_key=f"presence:{self.user_id}", log=False,
+        )
+
+    async def send_frame(self, user_ids, frame, notify_offline=True, coalesce_key=None, log=True):
+        # Logged frames get a seq in every recipient's event stream, so clients that are
+        # offline now can catch up on reconnect. Raises User.DoesNotExist, sending nothing,
+        # when a logged frame names an unknown user.
+        text = json.dumps(frame)
+        seqs = await database_sync_to_async(append_user_events)(user_ids, text) if log else None
+        await self.deliver(user_ids, frame, text, seqs, notify_offline, coalesce_key)
+
+    async def deliver(self, user_ids, frame, text, seqs=None, notify_offline=True, coalesce_key=None):
+        # Only users with a presence entry get the frame now (this connection's user always
+        # does); the rest catch up from the event log when they reconnect and go to
+        # offline_delivery. A connection whose entry was evicted is caught up when
+        # keep_presence recreates it.
+        others = {int(user_id) for user_id in user_ids} - {self.user_id}
+        online = await sync_to_async(presence.online_user_ids, thread_sensitive=False)(others) if others else set()
+        online.add(self.user_id)
+        recipients = [user_id for user_id in user_ids if int(user_id) in online]
+        if recipients:
+            await send_to_users(self.channel_layer, recipients, text, coalesce_key=coalesce_key, seqs=seqs)
+        if notify_offline and presence.offline_delivery.has_listeners():
+            for user_id in user_ids:
+                if int(user_id) not in online:
+                    await presence.offline_delivery.asend(sender=self.__class__, user_id=int(user_id), frame=frame)
+
+    async def replay_events(self, last_seq):
+        # Catches a reconnecting client up on the events it missed, or tells it to reload
+        # over REST when they are no longer all in the log
+        events, current = await database_sync_to_async(get_missed_events)(
+            self.user_id, last_seq, settings.CHAT_REPLAY_LIMIT
+        )
+        self.replayed_up_to = current
+        if events is None:
+            self.send_queue.put(json.dumps({'type': 'resync', 'data': {'seq': current}}))
         else:
-            # Create a new chat session and add both participants
-            chat_session = ChatSession.objects.create()
-            chat_session.participants.add(user1, user2)
-            return chat_session, True
+            for seq, text in events:
+                self.send_queue.put(with_seq(text, seq))
+                # Events logged after current was read can be among them
+                self.replayed_up_to = max(self.replayed_up_to, seq)
+        self.delivered_seq = max(self.delivered_seq, self.replayed_up_to)
+
+    async def forward_frame(self, event):
+        # Queue an already encoded frame for the WebSocket client
+        text = event['text']
+        seq = event.get('seqs', {}).get(str(self.user_id))
+        if seq is not None:
+            if seq <= self.replayed_up_to:
+                # Already sent by replay_events. Live frames can arrive out of seq order
+                # (concurrent senders), so they don't move this mark.
+                return
+            self.delivered_seq = max(self.delivered_seq, seq)
+            text = with_seq(text, seq)
+        if not self.send_queue.put(text, event.get('coalesce_key')):
+            metrics.increment('ws_slow_consumers_disconnected_total')
+            await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    async def drain_send_queue(self):
+        while True:
+            await self.send(**self.wire.encode(await self.send_queue.get()))
+
+    def send_error(self, code, **details):
+        self.send_queue.put(json.dumps({'type': 'error', 'code': code, **details}))
 
     async def save_message(self, sender_id, recipient_id, content):
-        # Retrieve sender and recipient from the database
-        sender = await database_sync_to_async(User.objects.get)(id=sender_id)
-        recipient = await database_sync_to_async(User.objects.get)(id=recipient_id)
-
-        # Get or create a chat session between sender and recipient
-        chat_session, created = await self.get_or_create_chat_session(sender_id, recipient_id)
-
-        # Create and save the new message
-        message = await database_sync_to_async(Message.objects.create)(
-            sender=sender,
-            content=content,
-            chat_session=chat_session
+        # One thread-pool hop: resolve the session (unless cached), insert the message and log its frame
+        pair_key = ChatSession.make_pair_key(sender_id, recipient_id)
+        message = await database_sync_to_async(save_direct_message)(
+            sender_id, recipient_id, content, self.chat_session_ids.get(pair_key), log=True
         )
-        return message
\ No newline at end of file
+        self.chat_session_ids[pair_key] = message.chat_session_id
+        return message
+
+    async def queue_message(self, sender_id, recipient_id, content):
+        pair_key = ChatSession.make_pair_key(sender_id, recipient_id)
+        chat_session_id = self.chat_session_ids.get(pair_key)
+        if chat_session_id is None:
+            chat_session, created = await database_sync_to_async(get_or_create_direct_session)(sender_id, recipient_id)
+            chat_session_id = self.chat_session_ids[pair_key] = chat_session.id
+        message = Message(chat_session_id=chat_session_id, sender_id=sender_id, content=content)
+        message.recipient_id = recipient_id
+        message_writer.enqueue(message)
+        return message
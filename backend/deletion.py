@@ -0,0 +1,77 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .caching import bump_versions, get_member_ids, invalidate, members_key
+from .models import User, ChatSession, Message, ChatReadCursor, Task, UserEvent, EventSequence
+from .tasks import run_in_background
+
+# Deletes for the heavy relations of users and chat sessions. Django's collector loads
+# every related row and sends per-object signals; these tables have no delete signals,
+# so their rows are removed with plain DELETEs of DELETE_BATCH_SIZE ids, each in its own
+# transaction so the write lock is only held briefly. What is left goes through the
+# normal delete().
+
+Participant = ChatSession.participants.through
+
+def delete_in_batches(queryset):
+    queryset = queryset.order_by()
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            ids = list(queryset.values_list('pk', flat=True)[:settings.DELETE_BATCH_SIZE])
+            if not ids:
+                return deleted
+            deleted += queryset.model.objects.filter(pk__in=ids)._raw_delete(queryset.db)
+
+def session_member_ids(chat_session_ids):
+    return {user_id for user_ids in get_member_ids(chat_session_ids).values() for user_id in user_ids}
+
+def forget_sessions(chat_session_ids, member_ids):
+    # Participant rows went without m2m_changed: drop the member sets and move the
+    # histories and inboxes on, once everything is gone
+    invalidate([members_key(chat_session_id) for chat_session_id in chat_session_ids])
+    bump_versions(chat_session_ids, member_ids)
+
+def delete_chat_session(chat_session):
+    chat_session_id = chat_session.id
+    member_ids = session_member_ids([chat_session_id])
+    # Logged frames first, or reconnecting clients would get the messages replayed
+    delete_in_batches(UserEvent.objects.filter(message__chat_session_id=chat_session_id))
+    delete_in_batches(Message.objects.filter(chat_session_id=chat_session_id))
+    delete_in_batches(ChatReadCursor.objects.filter(chat_session_id=chat_session_id))
+    delete_in_batches(Participant.objects.filter(chatsession_id=chat_session_id))
+    chat_session.delete()
+    forget_sessions([chat_session_id], member_ids)
+
+def delete_user(user_id):
+    # Same outcome as user.delete(): the user's messages (with their frames in the other
+    # participants' event logs), tasks, read cursors, events and memberships go, the
+    # sessions and the other participants' messages stay
+    chat_session_ids = list(Participant.objects.filter(user_id=user_id).values_list('chatsession_id', flat=True))
+    member_ids = session_member_ids(chat_session_ids)
+    delete_in_batches(UserEvent.objects.filter(message__sender_id=user_id))
+    delete_in_batches(Message.objects.filter(sender_id=user_id))
+    delete_in_batches(Task.objects.filter(user_id=user_id))
+    delete_in_batches(ChatReadCursor.objects.filter(user_id=user_id))
+    delete_in_batches(UserEvent.objects.filter(user_id=user_id))
+    delete_in_batches(EventSequence.objects.filter(user_id=user_id))
+    delete_in_batches(Participant.objects.filter(user_id=user_id))
+    user = User.objects.filter(pk=user_id).first()
+    if user is not None:
+        user.delete()
+    forget_sessions(chat_session_ids, member_ids)
+
+def request_user_deletion(user):
+    # Small accounts are deleted right away. Larger ones are marked deleted (deleted_at,
+    # and is_active so their tokens stop working) and removed by a background task;
+    # `manage.py purge_deleted_users` finishes any that a restart interrupted. Returns
+    # True when the deletion was deferred.
+    has_many_messages = Message.objects.filter(sender_id=user.id).order_by().values('id')[
+        settings.ACCOUNT_DELETE_BACKGROUND_THRESHOLD:settings.ACCOUNT_DELETE_BACKGROUND_THRESHOLD + 1
+    ].exists()
+    if not has_many_messages:
+        delete_user(user.id)
+        return False
+    User.objects.filter(pk=user.id).update(is_active=False, deleted_at=timezone.now())
+    run_in_background(delete_user, user.id)
+    return True
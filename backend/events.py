@@ -0,0 +1,127 @@
+import json
+from django.core.exceptions import ObjectDoesNotExist
+
+
+class FrameError(Exception):
+    # A frame the consumer can't handle; answered with an error frame instead of closing the socket
+    def __init__(self, code, **details):
+        super().__init__(code)
+        self.code = code
+        self.details = details
+
+
+# Field validators return the cleaned value or raise TypeError/ValueError
+
+# Ids are positive and fit the database's 64-bit integer columns (BigAutoField)
+MAX_ID = 2 ** 63 - 1
+
+def integer(value):
+    # Ids arrive as numbers or, from some clients, as numeric strings
+    if isinstance(value, bool):
+        raise TypeError
+    if isinstance(value, str) and value.isdigit():
+        value = int(value)
+    if not isinstance(value, int):
+        raise TypeError
+    if not 1 <= value <= MAX_ID:
+        raise ValueError
+    return value
+
+def string(value):
+    if not isinstance(value, str):
+        raise TypeError
+    return value
+
+def boolean(value):
+    if not isinstance(value, bool):
+        raise TypeError
+    return value
+
+
+class optional:
+    def __init__(self, validator):
+        self.validator = validator
+
+
+class Schema:
+    """
+    Payload fields an event needs, as name=validator (or optional(validator)).
+    Fields are split into required and optional tuples once, so validating a frame
+    is a loop over a few (name, validator) pairs. Undeclared keys are dropped.
+    """
+
+    def __init__(self, **fields):
+        self.required = tuple(
+            (name, validator) for name, validator in fields.items() if not isinstance(validator, optional)
+        )
+        self.optional = tuple(
+            (name, validator.validator) for name, validator in fields.items() if isinstance(validator, optional)
+        )
+
+    def validate(self, payload):
+        data = {}
+        for name, validator in self.required:
+            if name not in payload:
+                raise FrameError('missing_field', field=name)
+            try:
+                data[name] = validator(payload[name])
+            except (TypeError, ValueError):
+                raise FrameError('invalid_field', field=name)
+        for name, validator in self.optional:
+            value = payload.get(name)
+            if value is None:
+                continue
+            try:
+                data[name] = validator(value)
+            except (TypeError, ValueError):
+                raise FrameError('invalid_field', field=name)
+        return data
+
+
+class EventRegistry:
+    """
+    Maps incoming event types to handlers and their payload schemas.
+    Handlers are coroutines taking (consumer, data) where data is the validated payload.
+    They raise FrameError for frames they can't act on, e.g. naming an unknown user.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+
+    def handler(self, event_type, **fields):
+        def decorator(func):
+            self.handlers[event_type] = (func, Schema(**fields))
+            return func
+        return decorator
+
+    def relay(self, event_type, outgoing_type, **fields):
+        # Forwards the declared fields to the to_user, stamped with the sender
+        async def relay_event(consumer, data):
+            try:
+                await consumer.send_frame([data['to_user']], {
+                    'type': outgoing_type,
+                    'data': {**data, 'from_user': consumer.user_id},
+                })
+            except ObjectDoesNotExist:
+                raise FrameError('unknown_user', field='to_user')
+        self.handlers[event_type] = (relay_event, Schema(to_user=integer, **fields))
+
+    def resolve(self, event_type, payload):
+        # Returns the handler and the validated payload, or raises FrameError
+        try:
+            handler, schema = self.handlers[event_type]
+        except KeyError:
+            raise FrameError('unknown_event')
+        return handler, schema.validate(payload)
+
+
+def decode(data, loads=json.loads):
+    # Parses a frame into its payload dict and event type, or raises FrameError
+    try:
+        payload = loads(data)
+    except ValueError:
+        raise FrameError('invalid_json')
+    if not isinstance(payload, dict) or not isinstance(payload.get('type'), str):
+        raise FrameError('invalid_frame')
+    return payload, payload.get('type')
+
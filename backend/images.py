@@ -0,0 +1,36 @@
+import os
+from PIL import Image
+
+# Square thumbnails generated next to every profile picture, e.g.
+# profile_pics/me.png -> profile_pics/thumbs/me_96.jpg
+THUMBNAIL_SIZES = (48, 96, 256)
+INBOX_THUMBNAIL_SIZE = 96
+
+def thumbnail_name(name, size):
+    directory, filename = os.path.split(name)
+    root, ext = os.path.splitext(filename)
+    return os.path.join(directory, 'thumbs', f"{root}_{size}.jpg")
+
+def center_square(img):
+    size = min(img.size)
+    left = (img.width - size) // 2
+    top = (img.height - size) // 2
+    return img.crop((left, top, left + size, top + size))
+
+def process_profile_picture(path, name, media_root):
+    # Runs in a worker process: crops the original to a square and writes the thumbnails.
+    # Works on file paths only so it needs neither Django nor the database.
+    with Image.open(path) as img:
+        if img.height != img.width:
+            center_square(img).save(path)
+
+    with Image.open(path) as img:
+        # For JPEGs, let the decoder downscale by 1/2, 1/4 or 1/8 while still covering the largest thumbnail
+        largest = max(THUMBNAIL_SIZES)
+        img.draft('RGB', (largest, largest))
+        img = center_square(img.convert('RGB'))
+        for size in THUMBNAIL_SIZES:
+            thumbnail_path = os.path.join(media_root, thumbnail_name(name, size))
+            os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+            thumbnail = img.resize((size, size), Image.LANCZOS, reducing_gap=2.0)
+            thumbnail.save(thumbnail_path, format='JPEG', quality=85)
@@ -0,0 +1,55 @@
+import asyncio
+import json
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer as BaseInMemoryChannelLayer
+from . import metrics
+
+
+async def group_send_many(channel_layer, groups, message):
+    # Sends one event to several groups. Layers that implement group_send_many deliver it
+    # once per channel even when a channel belongs to more than one of the groups.
+    groups = list(dict.fromkeys(groups))
+    if hasattr(channel_layer, 'group_send_many'):
+        await channel_layer.group_send_many(groups, message)
+    elif len(groups) == 1:
+        await channel_layer.group_send(groups[0], message)
+    else:
+        await asyncio.gather(*(channel_layer.group_send(group, message) for group in groups))
+
+
+async def send_to_users(channel_layer, user_ids, frame, coalesce_key=None, seqs=None):
+    # Encodes the frame once (or takes it already encoded); every receiving socket
+    # forwards the text as is (ChatConsumer.forward_frame). Frames sharing a coalesce_key
+    # supersede each other in a full send queue. seqs maps user ids to the frame's
+    # position in their event streams (utils.append_user_events).
+    event = {
+        'type': 'forward_frame',
+        'text': frame if isinstance(frame, str) else json.dumps(frame),
+        'coalesce_key': coalesce_key,
+    }
+    if seqs:
+        # String keys, as msgpack in the Redis layers only unpacks those
+        event['seqs'] = {str(user_id): seq for user_id, seq in seqs.items()}
+    await group_send_many(channel_layer, [f"user_{user_id}" for user_id in user_ids], event)
+
+
+def with_seq(text, seq):
+    # Adds the stream position to an encoded frame without decoding it again
+    return f'{{"seq": {seq}, {text[1:]}'
+
+
+class InMemoryChannelLayer(BaseInMemoryChannelLayer):
+    async def group_send_many(self, groups, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        for group in groups:
+            self.require_valid_group_name(group)
+        self._clean_expired()
+
+        channels = dict.fromkeys(
+            channel for group in groups for channel in self.groups.get(group, {})
+        )
+        for channel in channels:
+            try:
+                await self.send(channel, message)
+            except ChannelFull:
+                metrics.increment('ws_frames_dropped_total', reason='channel_full')
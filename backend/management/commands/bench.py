@@ -0,0 +1,70 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from backend.benchmarks import BENCHMARKS, compare_results
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the named benchmarks (all of them by default) against a throwaway test database. "
+        "With --baseline, compares the results to a file written by --save-baseline and exits "
+        "with an error on regressions, e.g. in CI."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help=f"Benchmarks to run: {', '.join(sorted(BENCHMARKS))}")
+        parser.add_argument('--sizes', type=int, nargs='+', help="Dataset sizes for benchmarks that scale.")
+        parser.add_argument('--repeat', type=int, help="Number of timed iterations.")
+        parser.add_argument(
+            '--baseline',
+            help="Baseline JSON to compare with. Without names, reruns the baseline's benchmarks and options.",
+        )
+        parser.add_argument(
+            '--tolerance', type=float, default=0.5,
+            help="Fraction by which latencies may rise or throughputs fall before it counts as a regression.",
+        )
+        parser.add_argument('--save-baseline', help="Writes the results, with the options used, to this file.")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            if not options['names']:
+                for key in ('names', 'sizes', 'repeat'):
+                    options[key] = options[key] or baseline['options'][key]
+
+        names = options['names'] or sorted(BENCHMARKS)
+        unknown = set(names) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+
+        kwargs = {key: options[key] for key in ('sizes', 'repeat') if options[key]}
+        results = {}
+        # The REST benchmarks go through the test client
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            for name in names:
+                self.stderr.write(f"Running {name}...")
+                results[name] = BENCHMARKS[name](**kwargs)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(json.dumps(results, indent=2))
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump({
+                    'options': {'names': names, 'sizes': options['sizes'], 'repeat': options['repeat']},
+                    'results': results,
+                }, f, indent=2)
+                f.write('\n')
+        if baseline is not None:
+            regressions = compare_results(results, baseline['results'], options['tolerance'])
+            if regressions:
+                raise CommandError(
+                    f"{len(regressions)} regressions against {options['baseline']}:\n" + '\n'.join(regressions)
+                )
+            self.stderr.write(f"No regressions against {options['baseline']}.")
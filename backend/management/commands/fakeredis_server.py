@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs a fake Redis server (requires fakeredis) so several Daphne workers can share "
+        "a channel layer locally. Run the workers with CHANNEL_LAYER=redis-pubsub: the "
+        "default Redis layer relies on blocking pops that fakeredis does not serve well."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=6379)
+
+    def handle(self, *args, **options):
+        try:
+            from fakeredis import TcpFakeServer
+        except ImportError:
+            raise CommandError("fakeredis is not installed.")
+
+        server = TcpFakeServer((options['host'], options['port']), server_type='redis')
+        self.stdout.write(f"Fake Redis listening on redis://{options['host']}:{options['port']}/0")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
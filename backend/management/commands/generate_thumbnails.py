@@ -0,0 +1,21 @@
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from backend.images import process_profile_picture
+from backend.models import User
+
+
+class Command(BaseCommand):
+    help = "Crops existing profile pictures and generates their thumbnails."
+
+    def handle(self, *args, **options):
+        processed = failed = 0
+        users = User.objects.exclude(profile_picture='').exclude(profile_picture__isnull=True)
+        for name in users.values_list('profile_picture', flat=True).iterator():
+            try:
+                process_profile_picture(os.path.join(settings.MEDIA_ROOT, name), name, str(settings.MEDIA_ROOT))
+                processed += 1
+            except OSError as e:
+                failed += 1
+                self.stderr.write(f"Skipping {name}: {e}")
+        self.stdout.write(self.style.SUCCESS(f"Processed {processed} profile pictures ({failed} failed)."))
@@ -0,0 +1,207 @@
+import csv
+import datetime
+import json
+import time
+from functools import lru_cache
+from itertools import islice
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX, identify_hasher, make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from backend.caching import bump_versions, invalidate, members_key, profile_key
+from backend.models import User, ChatSession, Message
+
+Participant = ChatSession.participants.through
+
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 't', 'yes')
+
+def to_datetime(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f"not a date and time: {value!r}")
+    return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed, datetime.timezone.utc)
+
+# Columns read for each kind of row, with their converters. Ids are kept as given so rows
+# can refer to each other without the command holding an id map.
+COLUMNS = {
+    'users': {
+        'id': int, 'username': str, 'email': str, 'first_name': str, 'last_name': str,
+        'guest': to_bool, 'is_active': to_bool, 'date_joined': to_datetime,
+    },
+    'sessions': {'id': int, 'pair_key': str, 'created_at': to_datetime},
+    'participants': {'chat_session': int, 'user': int},
+    'messages': {
+        'id': int, 'chat_session': int, 'sender': int, 'content': str, 'timestamp': to_datetime, 'read': to_bool,
+    },
+}
+# Foreign keys are set by id, without loading the rows they point to
+FOREIGN_KEYS = {'chat_session': 'chat_session_id', 'sender': 'sender_id', 'user': 'user_id'}
+
+def chunks(iterable, size):
+    # Lists of up to size items, without holding more than one of them
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+@lru_cache(maxsize=1024)
+def hash_password(password):
+    # Fixtures tend to share a handful of passwords; each is hashed once
+    return make_password(password)
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports users, chat sessions, participants and messages from .jsonl or .csv files "
+        "with chunked bulk inserts, in constant memory, and reports rows per second. Rows "
+        "keep their ids: sessions, participants and messages refer to users and sessions by "
+        "id (chat_session, sender, user). User passwords may be Django password hashes, "
+        "which are stored as they are, or plain text, which is hashed. Users without one get "
+        "--password. Sessions without a pair_key get one from `manage.py merge_chat_sessions`."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', help="Users file: id, username, email, password, guest, ...")
+        parser.add_argument('--sessions', help="Chat sessions file: id, pair_key, created_at.")
+        parser.add_argument('--participants', help="Session members file: chat_session, user.")
+        parser.add_argument('--messages', help="Messages file: id, chat_session, sender, content, timestamp, read.")
+        parser.add_argument('--batch-size', type=int, default=2000, help="Rows per INSERT and transaction.")
+        parser.add_argument('--password', help="Password for users without one; unusable by default.")
+        parser.add_argument(
+            '--ignore-conflicts', action='store_true',
+            help="Skip rows that already exist (same id or unique value) instead of failing, e.g. on a rerun.",
+        )
+
+    def handle(self, *args, **options):
+        kinds = [kind for kind in COLUMNS if options[kind]]
+        if not kinds:
+            raise CommandError("Give at least one of --users, --sessions, --participants and --messages.")
+        self.batch_size = options['batch_size']
+        self.ignore_conflicts = options['ignore_conflicts']
+        # One hash shared by every user imported without a password
+        self.default_password = make_password(options['password'])
+
+        # In dependency order, so foreign keys point at rows that are already there
+        for kind in kinds:
+            path = options[kind]
+            start = time.perf_counter()
+            count = 0
+            if kind == 'messages':
+                # Ids from here on are the import's, unless rows bring lower ones
+                self.first_message_id = (Message.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+            for batch in self.read_batches(path, kind):
+                try:
+                    with transaction.atomic():
+                        getattr(self, f'insert_{kind}')(batch)
+                except DatabaseError as e:
+                    raise CommandError(f"{path}: batch after row {count} failed: {e}")
+                count += len(batch)
+                if options['verbosity'] > 1:
+                    self.stderr.write(f"{kind}: {count} rows")
+            if kind == 'messages':
+                self.bump_message_sessions()
+            elapsed = time.perf_counter() - start
+            self.stdout.write(self.style.SUCCESS(
+                f"{kind}: {count} rows in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f} rows/s)"
+            ))
+
+        # Explicit ids leave PostgreSQL's sequences behind; SQLite needs nothing
+        models = [model for kind, model in (('users', User), ('sessions', ChatSession), ('messages', Message))
+                  if kind in kinds]
+        statements = connection.ops.sequence_reset_sql(no_style(), models)
+        if statements:
+            with connection.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+
+    def read_rows(self, path):
+        # Row dicts one at a time, with empty CSV cells left out
+        with open(path, newline='', encoding='utf-8') as f:
+            if path.endswith('.csv'):
+                for row in csv.DictReader(f):
+                    yield {key: value for key, value in row.items() if value != ''}
+            else:
+                for number, line in enumerate(f, start=1):
+                    if line.strip():
+                        try:
+                            yield json.loads(line)
+                        except ValueError:
+                            raise CommandError(f"{path}, line {number}: not valid JSON")
+
+    def read_fields(self, path, kind):
+        # Model field values for each row
+        columns = COLUMNS[kind]
+        for number, row in enumerate(self.read_rows(path), start=1):
+            try:
+                fields = {
+                    FOREIGN_KEYS.get(name, name): convert(row[name])
+                    for name, convert in columns.items() if row.get(name) is not None
+                }
+            except (TypeError, ValueError) as e:
+                raise CommandError(f"{path}, row {number}: {e}")
+            if kind == 'users':
+                fields['password'] = self.password_hash(row.get('password'))
+            yield fields
+
+    def read_batches(self, path, kind):
+        return chunks(self.read_fields(path, kind), self.batch_size)
+
+    def password_hash(self, password):
+        if not password:
+            return self.default_password
+        if password.startswith(UNUSABLE_PASSWORD_PREFIX):
+            return password
+        try:
+            identify_hasher(password)
+            return password
+        except ValueError:
+            return hash_password(password)
+
+    # bulk_create sends no signals, so each batch clears the cache entries it made stale
+
+    def insert_users(self, batch):
+        users = User.objects.bulk_create(
+            [User(**fields) for fields in batch], ignore_conflicts=self.ignore_conflicts
+        )
+        invalidate([profile_key(user.id) for user in users if user.id is not None])
+
+    def insert_sessions(self, batch):
+        ChatSession.objects.bulk_create(
+            [ChatSession(**fields) for fields in batch], ignore_conflicts=self.ignore_conflicts
+        )
+
+    def insert_participants(self, batch):
+        Participant.objects.bulk_create(
+            [Participant(chatsession_id=fields['chat_session_id'], user_id=fields['user_id']) for fields in batch],
+            ignore_conflicts=self.ignore_conflicts,
+        )
+        session_ids = {fields['chat_session_id'] for fields in batch}
+        invalidate([members_key(session_id) for session_id in session_ids])
+        bump_versions(session_ids, {fields['user_id'] for fields in batch})
+
+    def insert_messages(self, batch):
+        Message.objects.bulk_create(
+            [Message(**fields) for fields in batch], ignore_conflicts=self.ignore_conflicts
+        )
+        explicit_ids = [fields['id'] for fields in batch if 'id' in fields]
+        if explicit_ids:
+            self.first_message_id = min(self.first_message_id, *explicit_ids)
+
+    def bump_message_sessions(self):
+        # A session takes messages from many batches, so the histories and inboxes that
+        # changed are bumped once at the end: every session with a message from the
+        # import's id range, streamed from the database
+        session_ids = Message.objects.filter(id__gte=self.first_message_id).order_by().values_list(
+            'chat_session_id', flat=True
+        ).distinct()
+        for batch in chunks(session_ids.iterator(), self.batch_size):
+            bump_versions(batch)
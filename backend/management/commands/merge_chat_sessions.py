@@ -0,0 +1,56 @@
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from backend.models import ChatSession, Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Backfills ChatSession.pair_key for direct chats and merges duplicate sessions "
+        "between the same two users into the oldest one."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report what would change without writing.")
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+
+        # Group sessions by participant set straight from the through table
+        participants = defaultdict(set)
+        Participant = ChatSession.participants.through
+        for session_id, user_id in Participant.objects.values_list('chatsession_id', 'user_id').iterator():
+            participants[session_id].add(user_id)
+
+        sessions_by_pair = defaultdict(list)
+        for session_id, user_ids in participants.items():
+            if len(user_ids) == 2:
+                sessions_by_pair[ChatSession.make_pair_key(*user_ids)].append(session_id)
+
+        existing_keys = dict(
+            ChatSession.objects.filter(pair_key__isnull=False).values_list('pair_key', 'id')
+        )
+
+        backfilled = merged = 0
+        for pair_key, session_ids in sessions_by_pair.items():
+            # Keep the session that already owns the key, otherwise the oldest one
+            keeper_id = existing_keys.get(pair_key, min(session_ids))
+            duplicate_ids = [session_id for session_id in session_ids if session_id != keeper_id]
+            if pair_key in existing_keys and not duplicate_ids:
+                continue
+
+            merged += len(duplicate_ids)
+            backfilled += pair_key not in existing_keys
+            if dry_run:
+                continue
+
+            with transaction.atomic():
+                if duplicate_ids:
+                    Message.objects.filter(chat_session_id__in=duplicate_ids).update(chat_session_id=keeper_id)
+                    ChatSession.objects.filter(id__in=duplicate_ids).delete()
+                ChatSession.objects.filter(id=keeper_id).update(pair_key=pair_key)
+
+        prefix = "Would merge" if dry_run else "Merged"
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix} {merged} duplicate sessions; {backfilled} sessions given a pair key."
+        ))
@@ -0,0 +1,18 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from backend.models import UserEvent
+
+
+class Command(BaseCommand):
+    help = "Deletes logged WebSocket events older than CHAT_EVENT_LOG_RETENTION_DAYS. Run it daily."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.CHAT_EVENT_LOG_RETENTION_DAYS)
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        # Clients that missed pruned events get a resync frame on their next connect
+        deleted, _ = UserEvent.objects.filter(created_at__lt=cutoff).delete()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} events."))
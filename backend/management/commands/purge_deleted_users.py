@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from backend.deletion import delete_user
+from backend.models import User
+
+
+class Command(BaseCommand):
+    help = "Finishes deleting accounts marked deleted whose background deletion was interrupted."
+
+    def handle(self, *args, **options):
+        user_ids = list(User.objects.filter(deleted_at__isnull=False).values_list('id', flat=True))
+        for user_id in user_ids:
+            delete_user(user_id)
+        self.stdout.write(self.style.SUCCESS(f"Deleted {len(user_ids)} accounts."))
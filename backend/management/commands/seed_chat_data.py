@@ -0,0 +1,29 @@
+import json
+import time
+from django.core.management.base import BaseCommand
+from backend.benchmarks import BENCH_PASSWORD, seed_dataset
+
+
+class Command(BaseCommand):
+    help = (
+        "Adds synthetic users, direct chat sessions and messages for load tests and prints a "
+        f"JSON summary, including one (user, contact) pair per user. The users' password is "
+        f"'{BENCH_PASSWORD}'. Never run it against a production database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--contacts', type=int, default=10, help="Direct sessions started by each user.")
+        parser.add_argument('--messages', type=int, default=20000)
+        parser.add_argument('--seed', type=int, default=0, help="Random seed, for repeatable datasets.")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        dataset = seed_dataset(options['users'], options['contacts'], options['messages'], seed=options['seed'])
+        self.stdout.write(json.dumps({
+            'users': len(dataset['user_ids']),
+            'sessions': dataset['sessions'],
+            'messages': options['messages'],
+            'seconds': round(time.perf_counter() - start, 2),
+            'pairs': dataset['pairs'],
+        }))
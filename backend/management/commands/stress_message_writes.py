@@ -0,0 +1,61 @@
+import json
+import os
+import threading
+import time
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+from backend.models import User
+from backend.utils import get_or_create_direct_session, mark_session_read, save_direct_message
+
+
+class Command(BaseCommand):
+    help = (
+        "Inserts chat messages (marking them read every tenth one) from several threads for "
+        "a while, like the consumer's database threads do, and prints the inserts and lock "
+        "errors as JSON. Run several at once against the same database to stress "
+        "concurrent writers (`manage.py bench concurrent_writes` does)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=4)
+        parser.add_argument('--seconds', type=float, default=5)
+
+    def handle(self, *args, **options):
+        results = [{'inserted': 0, 'lock_errors': 0} for _ in range(options['threads'])]
+        deadline = time.monotonic() + options['seconds']
+
+        def write(result, index):
+            pair = None
+            try:
+                while time.monotonic() < deadline:
+                    try:
+                        if pair is None:
+                            pair = self.create_pair(index)
+                        sender_id, recipient_id, chat_session_id = pair
+                        save_direct_message(sender_id, recipient_id, "stress", chat_session_id)
+                        result['inserted'] += 1
+                        if result['inserted'] % 10 == 0:
+                            # Read-then-write transactions are the ones prone to lock errors
+                            mark_session_read(recipient_id, chat_session_id)
+                    except OperationalError:
+                        result['lock_errors'] += 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=write, args=(result, i)) for i, result in enumerate(results)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.stdout.write(json.dumps({
+            'inserted': sum(result['inserted'] for result in results),
+            'lock_errors': sum(result['lock_errors'] for result in results),
+        }))
+
+    def create_pair(self, index):
+        # Two users of this thread and their direct session
+        sender, _ = User.objects.get_or_create(username=f'stress_{os.getpid()}_{index}_a')
+        recipient, _ = User.objects.get_or_create(username=f'stress_{os.getpid()}_{index}_b')
+        chat_session, _ = get_or_create_direct_session(sender.id, recipient.id)
+        return sender.id, recipient.id, chat_session.id
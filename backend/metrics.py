@@ -0,0 +1,80 @@
+import math
+import threading
+from collections import defaultdict
+
+# In-process counters and histograms, keyed by (name, sorted label pairs)
+_counters = defaultdict(int)
+_histograms = {}
+_lock = threading.Lock()
+
+# Upper bounds of the histogram buckets, in seconds unless a histogram passes its own
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+def increment(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] += amount
+
+def get_counter(name, **labels):
+    return _counters.get((name, tuple(sorted(labels.items()))), 0)
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+def observe(name, value, buckets=DURATION_BUCKETS, **labels):
+    # Histograms keep a count per bucket (not cumulative), the sum and the total count
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = {'buckets': buckets, 'counts': [0] * (len(buckets) + 1), 'sum': 0, 'count': 0}
+        histogram = _histograms[key]
+        index = next((i for i, bound in enumerate(histogram['buckets']) if value <= bound), len(histogram['buckets']))
+        histogram['counts'][index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+def get_histogram(name, **labels):
+    with _lock:
+        histogram = _histograms.get((name, tuple(sorted(labels.items()))))
+        return dict(histogram, counts=list(histogram['counts'])) if histogram else None
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')) for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+def render():
+    # Everything recorded so far in the Prometheus text exposition format
+    with _lock:
+        counter_items = sorted(_counters.items())
+        histogram_items = sorted(
+            (key, dict(histogram, counts=list(histogram['counts']))) for key, histogram in _histograms.items()
+        )
+    lines = []
+    typed = set()
+    for (name, labels), value in counter_items:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+    for (name, labels), histogram in histogram_items:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, count in zip(histogram['buckets'] + (math.inf,), histogram['counts']):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', format_value(float(bound))),))} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {format_value(histogram['sum'])}")
+        lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+    return '\n'.join(lines) + '\n'
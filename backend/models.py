@@ -1,27 +1,33 @@
-from django.db import models
+from uuid import uuid4
+from django.db import models, transaction
 from django.conf import settings
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
-from PIL import Image
+from django.core.files.storage import default_storage
+from .images import INBOX_THUMBNAIL_SIZE, process_profile_picture, thumbnail_name
+from .tasks import run_in_background
 
 # Create your models here.
 
 class User(AbstractUser):
     profile_picture = models.ImageField(upload_to='profile_pics/', null=True, blank=True)
     guest = models.BooleanField(default=False)
+    # Set when the account is waiting to be deleted in the background (backend/deletion.py)
+    deleted_at = models.DateTimeField(null=True, blank=True)
 
     def save(self, *args, **kwargs):
+        # A freshly uploaded file is uncommitted until super().save() stores it
+        picture_changed = bool(self.profile_picture) and not self.profile_picture._committed
         super().save(*args, **kwargs)
-        if self.profile_picture:
-            img_path = self.profile_picture.path
-            img = Image.open(img_path)
-            if img.height != img.width:
-                size = min(img.size)  # Ensuring the image is square
-                left = (img.width - size) / 2
-                top = (img.height - size) / 2
-                right = (img.width + size) / 2
-                bottom = (img.height + size) / 2
-                img = img.crop((left, top, right, bottom))
-                img.save(img_path)
+        if picture_changed:
+            # Cropping and thumbnails happen in a worker process once the upload is committed
+            task_args = (self.profile_picture.path, self.profile_picture.name, str(settings.MEDIA_ROOT))
+            transaction.on_commit(lambda: run_in_background(process_profile_picture, *task_args, kind='process'))
+
+    def profile_picture_thumbnail(self, size=INBOX_THUMBNAIL_SIZE):
+        if not self.profile_picture:
+            return None
+        return default_storage.url(thumbnail_name(self.profile_picture.name, size))
 
     def __str__(self):
         return self.username
@@ -31,14 +37,26 @@ class Task(models.Model):
     task_name = models.CharField(max_length=255)
     description = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at'], name='task_user_created_idx'),
+        ]
     
     def __str__(self):
         return self.task_name
     
 class ChatSession(models.Model):
     participants = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name='chats', blank=True)
+    # "<lower user id>:<higher user id>" for direct chats, so a conversation is found with one indexed lookup
+    pair_key = models.CharField(max_length=64, unique=True, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    @staticmethod
+    def make_pair_key(user_id_a, user_id_b):
+        low, high = sorted([int(user_id_a), int(user_id_b)])
+        return f"{low}:{high}"
+
     def __str__(self):
         return f"ChatSession {self.pk}"
 
@@ -46,9 +64,66 @@ class Message(models.Model):
     chat_session = models.ForeignKey(ChatSession, related_name='messages', on_delete=models.CASCADE)
     sender = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='sent_messages', on_delete=models.CASCADE)
     content = models.TextField(blank=True, null=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # A default rather than auto_now_add so write-behind batches keep the time the message was sent
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
     read = models.BooleanField(default=False)
+    # Set when the message is created, before it has an id (write-behind), so clients can
+    # match the live frame with the logged one and with the history
+    uuid = models.UUIDField(default=uuid4, unique=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Backs keyset pagination of a session's history and the inbox's last-message lookup
+            models.Index(fields=['chat_session', 'timestamp', 'id'], name='message_session_time_idx'),
+            # Backs unread counts, which compare ids against a read cursor
+            models.Index(fields=['chat_session', 'id'], name='message_session_id_idx'),
+            models.Index(fields=['sender', 'timestamp'], name='message_sender_time_idx'),
+        ]
 
     def __str__(self):
         return f"Message from {self.sender} on {self.timestamp}"
 
+class ChatReadCursor(models.Model):
+    # How far a user has read in a chat session; everything after it is unread
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='read_cursors', on_delete=models.CASCADE)
+    chat_session = models.ForeignKey(ChatSession, related_name='read_cursors', on_delete=models.CASCADE)
+    last_read_message_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'chat_session'], name='unique_read_cursor'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} read {self.chat_session_id} up to {self.last_read_message_id}"
+
+class EventSequence(models.Model):
+    # The last sequence number handed out in a user's event stream. Kept apart from User
+    # so profile saves never write a stale counter back.
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, primary_key=True, related_name='event_sequence', on_delete=models.CASCADE)
+    last_seq = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.user_id} at {self.last_seq}"
+
+class UserEvent(models.Model):
+    # Recent frames sent to a user, replayed to a reconnecting client from its last seen seq
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='events', on_delete=models.CASCADE)
+    seq = models.PositiveBigIntegerField()
+    # The encoded frame without its seq
+    frame = models.TextField()
+    # The message the frame carries, if any, so deleting it drops the frame from replays
+    message = models.ForeignKey(Message, related_name='events', null=True, blank=True, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'seq'], name='unique_user_event_seq'),
+        ]
+        indexes = [
+            models.Index(fields=['created_at'], name='user_event_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"Event {self.seq} for {self.user_id}"
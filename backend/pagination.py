@@ -0,0 +1,87 @@
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+
+
+class MessageKeysetPagination(BasePagination):
+    """
+    Keyset pagination over (timestamp, id) for a chat session's messages.
+    - ?before=<message id> returns the page just older than that message.
+    - ?after=<message id> returns the page just newer than that message.
+    - ?since_id=<message id> returns messages created after that id (reconnect deltas).
+    - ?limit=<n> alone returns the latest page.
+    Pages are always returned oldest first.
+    """
+    default_limit = 50
+    max_limit = 200
+    cursor_params = ('before', 'after', 'since_id')
+
+    def is_requested(self, request):
+        return any(param in request.query_params for param in self.cursor_params + ('limit',))
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get('limit', self.default_limit))
+        except ValueError:
+            raise ValidationError({'limit': 'Must be an integer.'})
+        return max(1, min(limit, self.max_limit))
+
+    def get_message_id(self, request, param):
+        value = request.query_params.get(param)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise ValidationError({param: 'Must be a message id.'})
+
+    def get_position(self, queryset, message_id, param):
+        position = queryset.filter(pk=message_id).values_list('timestamp', 'id').first()
+        if position is None:
+            raise ValidationError({param: 'Unknown message.'})
+        return position
+
+    def paginate_queryset(self, queryset, request, view=None):
+        limit = self.get_limit(request)
+        before = self.get_message_id(request, 'before')
+        after = self.get_message_id(request, 'after')
+        since_id = self.get_message_id(request, 'since_id')
+
+        if since_id is not None:
+            page = queryset.filter(id__gt=since_id).order_by('timestamp', 'id')
+            newest_first = False
+        elif after is not None:
+            timestamp, message_id = self.get_position(queryset, after, 'after')
+            page = queryset.filter(
+                Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)
+            ).order_by('timestamp', 'id')
+            newest_first = False
+        else:
+            if before is not None:
+                timestamp, message_id = self.get_position(queryset, before, 'before')
+                queryset = queryset.filter(
+                    Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+                )
+            page = queryset.order_by('-timestamp', '-id')
+            newest_first = True
+
+        # Fetch one extra row to know whether another page exists
+        results = list(page[:limit + 1])
+        self.has_more = len(results) > limit
+        results = results[:limit]
+        if newest_first:
+            results.reverse()
+        return results
+
+    def get_paginated_response(self, data):
+        return Response({
+            'results': data,
+            'has_more': self.has_more,
+        })
+
+
+class DefaultPagination(PageNumberPagination):
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
@@ -0,0 +1,68 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.dispatch import Signal
+
+# Sent for every frame addressed to a user with no live connection, with user_id and
+# frame. Hook push notifications up here; the messages themselves are already saved and
+# clients catch up through /chat/<id>/?since_id=.
+offline_delivery = Signal()
+
+# Who is connected, shared between server processes through the cache: a count of live
+# connections per user, so several devices can be online at once. The count only changes
+# through the cache's atomic incr/decr, so devices connecting at the same time in
+# different workers can't overwrite each other. Every connection refreshes the entry each
+# PRESENCE_TTL / 2 seconds (ChatConsumer.keep_presence); connections of a worker that died
+# without unregistering them keep the user online until the entry expires. Frames only go
+# to users with an entry; a connection that finds its entry evicted recreates it and
+# replays the frames it missed from the event log.
+
+def presence_key(user_id):
+    return f"presence:{user_id}"
+
+def register(user_id):
+    # Counts a new connection. Returns True when the user just came online.
+    key = presence_key(user_id)
+    cache.add(key, 0, settings.PRESENCE_TTL)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # Expired between add() and incr()
+        count = 0
+    if count < 1:
+        # Left below one by connections that closed after the entry was evicted and recreated
+        cache.set(key, 1, settings.PRESENCE_TTL)
+        count = 1
+    return count == 1
+
+def refresh(user_id):
+    # Keeps a live connection's entry from expiring, and recreates it when it was evicted.
+    # Returns True when that brought the user back online.
+    if cache.touch(presence_key(user_id), settings.PRESENCE_TTL):
+        return False
+    return register(user_id)
+
+def unregister(user_id):
+    # Uncounts a connection. Returns True when it was the user's last one.
+    key = presence_key(user_id)
+    try:
+        count = cache.decr(key)
+    except ValueError:
+        # Already expired or evicted
+        return True
+    if count < 1:
+        cache.delete(key)
+        return True
+    return False
+
+def online_user_ids(user_ids):
+    keys = {presence_key(user_id): int(user_id) for user_id in user_ids}
+    return {keys[key] for key, count in cache.get_many(keys).items() if count > 0}
+
+def presence_frame(user_id, online):
+    return {
+        'type': 'presence',
+        'data': {
+            'user': int(user_id),
+            'online': online,
+        },
+    }
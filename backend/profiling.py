@@ -0,0 +1,151 @@
+import contextvars
+import logging
+import time
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Per-request and per-WebSocket-event timings: wall time, database queries and their time,
+# and time spent in serializers. The profile in progress lives in a context variable, so
+# queries run from sync_to_async threads are counted against the request or event that
+# started them. Results go to the histograms in backend.metrics; anything slower than
+# SLOW_REQUEST_MS is logged with its SQL.
+
+current_profile = contextvars.ContextVar('current_profile', default=None)
+
+# Statements kept per profile for the slow log
+MAX_LOGGED_QUERIES = 50
+
+
+class Profile:
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration = None
+        self.query_count = 0
+        self.query_seconds = 0.0
+        self.queries = []
+        self.serializer_seconds = 0.0
+        self.serializer_depth = 0
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+        prefix, labels = ('http_request', {'route': self.name}) if self.kind == 'http' else ('ws_event', {'event': self.name})
+        metrics.observe(f'{prefix}_duration_seconds', self.duration, **labels)
+        metrics.observe(f'{prefix}_db_queries', self.query_count, buckets=metrics.COUNT_BUCKETS, **labels)
+        metrics.observe(f'{prefix}_db_duration_seconds', self.query_seconds, **labels)
+        metrics.observe(f'{prefix}_serializer_duration_seconds', self.serializer_seconds, **labels)
+        if self.duration * 1000 >= settings.SLOW_REQUEST_MS:
+            logger.warning(
+                "Slow %s %s: %.1f ms, %d queries in %.1f ms, %.1f ms serializing\n%s",
+                self.kind, self.name, self.duration * 1000, self.query_count, self.query_seconds * 1000,
+                self.serializer_seconds * 1000, '\n'.join(f"{query['ms']} ms: {query['sql']}" for query in self.queries),
+                extra={'profile': {
+                    'kind': self.kind,
+                    'name': self.name,
+                    'duration_ms': round(self.duration * 1000, 1),
+                    'query_count': self.query_count,
+                    'query_ms': round(self.query_seconds * 1000, 1),
+                    'serializer_ms': round(self.serializer_seconds * 1000, 1),
+                    'queries': self.queries,
+                }},
+            )
+
+
+def start_profile(kind, name):
+    profile = Profile(kind, name)
+    return profile, current_profile.set(profile)
+
+def finish_profile(profile, token):
+    current_profile.reset(token)
+    profile.finish()
+
+def name_profile(name):
+    # Labels the profile in progress once the route or event type is known
+    profile = current_profile.get()
+    if profile is not None:
+        profile.name = name
+
+
+def record_query(execute, sql, params, many, context):
+    # Installed with connection.execute_wrappers on every connection; a no-op outside a profile
+    profile = current_profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - start
+        profile.query_count += 1
+        profile.query_seconds += duration
+        if len(profile.queries) < MAX_LOGGED_QUERIES:
+            profile.queries.append({'sql': sql, 'ms': round(duration * 1000, 3)})
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    # Connections run in whichever thread sync_to_async picks, so the wrapper is installed
+    # on all of them rather than with `with connection.execute_wrapper()` around one request
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class ProfiledSerializerMixin:
+    """
+    Adds the time spent turning instances into data and validating input to the current
+    profile. Nested serializers and list items are counted once, by the outermost call.
+    """
+
+    def timed(self, method, *args):
+        profile = current_profile.get()
+        if profile is None:
+            return method(*args)
+        profile.serializer_depth += 1
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            profile.serializer_depth -= 1
+            if not profile.serializer_depth:
+                profile.serializer_seconds += time.perf_counter() - start
+
+    def to_representation(self, instance):
+        return self.timed(super().to_representation, instance)
+
+    def run_validation(self, *args):
+        return self.timed(super().run_validation, *args)
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profile, token = start_profile('http', 'unmatched')
+        try:
+            response = self.get_response(request)
+        finally:
+            # URL names rather than paths, so ids don't make a series each
+            match = getattr(request, 'resolver_match', None)
+            if match is not None:
+                profile.name = match.view_name
+            finish_profile(profile, token)
+        return response
+
+
+class ProfiledConsumerMixin:
+    """
+    Profiles each frame a consumer receives. The consumer names the event with
+    name_profile() once it knows the type; frames it rejects earlier count as 'invalid'.
+    """
+
+    async def websocket_receive(self, message):
+        profile, token = start_profile('ws', 'invalid')
+        try:
+            await super().websocket_receive(message)
+        finally:
+            finish_profile(profile, token)
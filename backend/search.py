@@ -0,0 +1,68 @@
+from django.db import connections
+from .models import Message
+
+# Full-text search over message content. On SQLite an FTS5 table mirrors
+# backend_message through triggers, so bulk inserts and raw deletes stay in step; on
+# PostgreSQL a GIN index over the content's tsvector backs the search. Both are created
+# after migrate (the app has no migrations). Other databases fall back to icontains.
+
+MESSAGE_TABLE = Message._meta.db_table
+FTS_TABLE = f'{MESSAGE_TABLE}_fts'
+# Must match the expression SearchVector('content', config='simple') compiles to
+POSTGRES_VECTOR = "to_tsvector('simple'::regconfig, COALESCE(content, ''))"
+
+SQLITE_SCHEMA = [
+    f"""CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+        content, content='{MESSAGE_TABLE}', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON {MESSAGE_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON {MESSAGE_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE OF content ON {MESSAGE_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END""",
+    # Index the messages that existed before the table did
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+]
+
+def install_search_index(sender=None, using='default', **kwargs):
+    # post_migrate receiver
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            if FTS_TABLE in connection.introspection.table_names(cursor):
+                return
+            for statement in SQLITE_SCHEMA:
+                cursor.execute(statement)
+        elif connection.vendor == 'postgresql':
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS message_content_search_idx ON {MESSAGE_TABLE} USING GIN ({POSTGRES_VECTOR})"
+            )
+
+def fts_query(text):
+    # Every word must appear; quoting keeps FTS5 operators in user input literal
+    return ' '.join('"{}"'.format(term.replace('"', '""')) for term in text.split())
+
+def search_messages(queryset, text):
+    # Narrows a Message queryset to matches for text, best matches first
+    vendor = connections[queryset.db].vendor
+    if vendor == 'sqlite':
+        return queryset.extra(
+            tables=[FTS_TABLE],
+            where=[f'{FTS_TABLE}.rowid = {MESSAGE_TABLE}.id', f'{FTS_TABLE} MATCH %s'],
+            params=[fts_query(text)],
+            select={'rank': f'bm25({FTS_TABLE})'},
+            order_by=['rank', '-timestamp'],
+        )
+    if vendor == 'postgresql':
+        from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+        vector = SearchVector('content', config='simple')
+        query = SearchQuery(text, config='simple')
+        return queryset.annotate(search=vector).filter(search=query).annotate(
+            rank=SearchRank(vector, query)
+        ).order_by('-rank', '-timestamp')
+    return queryset.filter(content__icontains=text).order_by('-timestamp')
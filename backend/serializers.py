@@ -1,11 +1,21 @@
+from django.conf import settings
+from django.db import transaction
 from rest_framework import serializers
+from .caching import get_session_profiles, invalidate, members_key
 from .models import User, Message, ChatSession, Task
+from .profiling import ProfiledSerializerMixin
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from django.utils.timesince import timesince
 from django.core.validators import RegexValidator, MinLengthValidator, MaxLengthValidator
 from django.core.files.images import get_image_dimensions
+import logging
 import uuid
 
+logger = logging.getLogger(__name__)
+
+MAX_PROFILE_PICTURE_BYTES = 10 * 1024 * 1024
+MAX_PROFILE_PICTURE_DIMENSION = 4000
+
 class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
     @classmethod
     def get_token(cls, user):
@@ -13,7 +23,7 @@ class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
         token['username'] = user.username
         return token
 
-class UserRegistrationSerializer(serializers.ModelSerializer):
+class UserRegistrationSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     username = serializers.CharField(
         validators=[
             RegexValidator(
@@ -62,7 +72,7 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
         )
         return user
     
-class GuestRegistrationSerializer(serializers.ModelSerializer):
+class GuestRegistrationSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     username = serializers.CharField(
         required=False,  # No longer required in the incoming request
         default='',
@@ -76,67 +86,52 @@ class GuestRegistrationSerializer(serializers.ModelSerializer):
             MaxLengthValidator(20, message="Username must be no longer than 20 characters.")
         ]
     )
-    password = serializers.CharField(
-        required=False,  # No longer required in the incoming request
-        default='',
-        write_only=True,
-        validators=[
-            RegexValidator(
-                regex=r'^[a-zA-Z0-9!@#$%^&*()_+=\[\]{};:\'"\\|,.<>\/?~-]+$',
-                message="Password must consist of alphanumeric and special characters only."
-            ),
-            MinLengthValidator(8, message="Password must be at least 8 characters long."),
-            MaxLengthValidator(20, message="Password must be no longer than 20 characters.")
-        ]
-    )
     email = serializers.EmailField(read_only=True)
 
     class Meta:
         model = User
-        fields = ('username', 'password', 'email', 'guest')
+        fields = ('username', 'email', 'guest')
 
     def validate(self, data):
         # Generate values
         data['username'] = f"guest_{uuid.uuid4().hex[:8]}"
         data['email'] = f"{data['username']}@example.com"
-        data['password'] = uuid.uuid4().hex[:20]
 
         # Apply validators manually since these fields are read-only and would skip normal validation
         for validator in self.fields['username'].validators:
             validator(data['username'])
-        for validator in self.fields['password'].validators:
-            validator(data['password'])
 
         return data
 
     def create(self, validated_data):
-        # Extract the plaintext password from validated data before creating the user
-        plaintext_password = validated_data['password']
-
-        # Create the user object
-        user = User.objects.create_user(
-            username=validated_data['username'],
-            email=validated_data['email'],
-            password=plaintext_password,  # Django hashes the password here
-            guest=True
-        )
-
-         # Create or retrieve a ChatSession for the guest and John or user with ID 1
-        john_user = User.objects.get(id=27)  # Assuming user with ID 1 exists and is John
-        chat_session = ChatSession.objects.create()
-        chat_session.participants.add(user, john_user)
-
-        # Create an initial message in this chat session
-        Message.objects.create(
-            chat_session=chat_session,
-            sender=john_user,
-            content="Welcome to Discourse!"
-        )
-
-        # Return both the user object and the plaintext password
-        return user, plaintext_password
+        welcome_bot_id = settings.WELCOME_BOT_USER_ID
+        with transaction.atomic():
+            user = User(
+                username=validated_data['username'],
+                email=validated_data['email'],
+                guest=True
+            )
+            # Guests only ever sign in with the tokens issued at signup, so skip the password hasher
+            user.set_unusable_password()
+            user.save()
+
+            # Welcome conversation with the welcome bot, inserted by id without loading the bot user
+            chat_session = ChatSession.objects.create(pair_key=ChatSession.make_pair_key(user.id, welcome_bot_id))
+            Participant = ChatSession.participants.through
+            Participant.objects.bulk_create([
+                Participant(chatsession_id=chat_session.id, user_id=user.id),
+                Participant(chatsession_id=chat_session.id, user_id=welcome_bot_id),
+            ])
+            # bulk_create sends no m2m_changed
+            invalidate([members_key(chat_session.id)])
+            Message.objects.create(
+                chat_session=chat_session,
+                sender_id=welcome_bot_id,
+                content="Welcome to Discourse!"
+            )
+        return user
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['username', 'id','profile_picture']
@@ -148,49 +143,75 @@ class UserSerializer(serializers.ModelSerializer):
         """
         Validates the uploaded image.
         - Checks that it is a JPEG, PNG, or MPO file by MIME type.
-        - Ensures the file size does not exceed 2MB.
+        - Ensures the file size does not exceed 10MB and the dimensions 4000x4000.
         """
         # Validate file type by MIME type
         valid_mime_types = ['image/jpeg', 'image/png', 'image/mpo']
         mime_type = value.content_type  # Directly access content_type
-        print(f"File MIME type: {mime_type}")  # Log the MIME type
+        logger.debug("Profile picture MIME type %s", mime_type)
         if mime_type not in valid_mime_types:
             raise serializers.ValidationError("File must be a JPEG or PNG image.")
 
         # Validate file size
-        if value.size > 10 * 1024 * 1024:  # 2MB limit
-            raise serializers.ValidationError("Image file too large ( > 2MB ).")
+        if value.size > MAX_PROFILE_PICTURE_BYTES:
+            raise serializers.ValidationError("Image file too large ( > 10MB ).")
 
         # Optionally, validate image dimensions
         width, height = get_image_dimensions(value)
-        if width > 8000 or height > 8000:
+        if width > MAX_PROFILE_PICTURE_DIMENSION or height > MAX_PROFILE_PICTURE_DIMENSION:
             raise serializers.ValidationError("Image dimensions should not be greater than 4000x4000 pixels.")
 
         return value
     
-class TaskSerializer(serializers.ModelSerializer):
+class TaskSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Task
         fields = ['id', 'user', 'task_name', 'description', 'created_at']
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = '__all__'
 
-class ChatSessionSerializer(serializers.ModelSerializer):
-    participants = UserSerializer(many=True, read_only=True)
+class ChatSessionSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
+    # Participants are {'username', 'id', 'profile_picture'} built from cached profiles
+    participants = serializers.SerializerMethodField()
     last_message = serializers.SerializerMethodField()
+    picture_field = 'profile_picture'
     class Meta:
         model = ChatSession
         fields = ['id', 'created_at', 'participants', 'last_message']
 
+    def get_participants(self, obj):
+        profiles = getattr(obj, 'participant_profiles', None)  # Already loaded by get_inbox_sessions
+        if profiles is None:
+            profiles = get_session_profiles([obj.id])[obj.id]
+        request = self.context.get('request')
+        participants = []
+        for profile in profiles:
+            url = profile[self.picture_field]
+            if url and request:
+                url = request.build_absolute_uri(url)
+            participants.append({'username': profile['username'], 'id': profile['id'], 'profile_picture': url})
+        return participants
+
     def get_last_message(self, obj):
-        last_message = obj.messages.order_by('-timestamp').first()  # Get the most recent message
+        if hasattr(obj, 'inbox_last_message'):
+            last_message = obj.inbox_last_message  # Already loaded by get_inbox_sessions
+        else:
+            last_message = obj.messages.order_by('-timestamp').first()  # Get the most recent message
         if last_message:
             time_since = timesince(last_message.timestamp).split(',')[0]  # Simplify to the most significant unit
-            if last_message.sender == self.context['request'].user:
+            if last_message.sender_id == self.context['request'].user.id:
                 return {"message": f"You: {last_message.content}", "timestamp": time_since, "exact_time": last_message.timestamp.isoformat(), "read": last_message.read, "id": last_message.id, "sender": "user"}
             else:
                 return {"message": last_message.content, "timestamp": time_since, "exact_time": last_message.timestamp.isoformat(), "read": last_message.read, "id": last_message.id, "sender": "other_user"}
-        return None
\ No newline at end of file
+        return None
+
+class InboxChatSessionSerializer(ChatSessionSerializer):
+    # Inbox avatars use the small thumbnail rather than the full-size original
+    picture_field = 'thumbnail'
+    unread_count = serializers.IntegerField(read_only=True)
+
+    class Meta(ChatSessionSerializer.Meta):
+        fields = ChatSessionSerializer.Meta.fields + ['unread_count']
@@ -0,0 +1,36 @@
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Local task backend: CPU-bound work goes to a process pool, database work to a thread pool.
+# With BACKGROUND_TASKS_EAGER (tests) tasks run inline instead.
+_executors = {}
+
+def get_executor(kind):
+    if kind not in _executors:
+        if kind == 'process':
+            # spawn rather than fork: the server process may be running threads and an event loop
+            _executors[kind] = ProcessPoolExecutor(
+                max_workers=settings.BACKGROUND_PROCESS_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        else:
+            _executors[kind] = ThreadPoolExecutor(
+                max_workers=settings.BACKGROUND_THREAD_WORKERS, thread_name_prefix='background'
+            )
+    return _executors[kind]
+
+def log_failure(future):
+    if future.exception() is not None:
+        logger.error("Background task failed", exc_info=future.exception())
+
+def run_in_background(func, *args, kind='thread'):
+    # Process tasks must be module-level functions taking picklable arguments
+    if settings.BACKGROUND_TASKS_EAGER:
+        return func(*args)
+    future = get_executor(kind).submit(func, *args)
+    future.add_done_callback(log_failure)
+    return future
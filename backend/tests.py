@@ -1,3 +1,1121 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import zlib
+from io import BytesIO, StringIO
+from unittest import mock
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from . import metrics
+from .auth import JWTAuthMiddleware
+from .benchmarks import BENCH_PASSWORD, compare_results
+from .caching import chat_version_key, get_member_ids, get_version
+from .consumers import ChatConsumer
+from .deletion import delete_chat_session
+from .images import THUMBNAIL_SIZES, thumbnail_name
+from .layers import InMemoryChannelLayer, group_send_many
+from .models import User, ChatSession, Message, Task, UserEvent
+from .presence import offline_delivery, online_user_ids, refresh, register, unregister
+from .routing import websocket_urlpatterns
+from .throttling import SendQueue
+from .utils import append_user_events, get_or_create_direct_session, save_direct_message
 
 # Create your tests here.
+
+def create_conversation(user, other, messages=1):
+    chat_session = ChatSession.objects.create(pair_key=ChatSession.make_pair_key(user.id, other.id))
+    chat_session.participants.add(user, other)
+    for i in range(messages):
+        sender = other if i % 2 == 0 else user
+        Message.objects.create(chat_session=chat_session, sender=sender, content=f"message {i}")
+    return chat_session
+
+class UserChatSessionsViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='inbox_owner')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add_conversations(self, count):
+        for i in range(count):
+            other = User.objects.create(username=f'other_{ChatSession.objects.count()}')
+            create_conversation(self.user, other, messages=3)
+
+    def test_inbox_query_count_is_constant(self):
+        self.add_conversations(2)
+        cache.clear()
+        # Participants and profiles are loaded once, then served from the cache
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('user_chats'))
+        self.assertEqual(len(response.data), 2)
+        with self.assertNumQueries(2):
+            self.client.get(reverse('user_chats'))
+
+        self.add_conversations(20)
+        cache.clear()
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('user_chats'))
+        self.assertEqual(len(response.data), 22)
+        with self.assertNumQueries(2):
+            self.client.get(reverse('user_chats'))
+
+    def test_cached_participants_follow_profile_and_membership_changes(self):
+        other = User.objects.create(username='before')
+        chat_session = create_conversation(self.user, other)
+        self.client.get(reverse('user_chats'))
+
+        other.username = 'after'
+        other.save()
+        newcomer = User.objects.create(username='newcomer')
+        chat_session.participants.add(newcomer)
+        response = self.client.get(reverse('user_chats'))
+        self.assertEqual(
+            sorted(participant['username'] for participant in response.data[0]['participants']),
+            ['after', 'inbox_owner', 'newcomer'],
+        )
+
+        hits = metrics.get_counter('cache_requests_total', cache='profile', result='hit')
+        self.client.get(reverse('user_chats'))
+        self.assertEqual(metrics.get_counter('cache_requests_total', cache='profile', result='hit'), hits + 3)
+
+    def test_inbox_last_message_and_unread_count(self):
+        other = User.objects.create(username='other')
+        chat_session = create_conversation(self.user, other, messages=3)
+        empty_session = ChatSession.objects.create()
+        empty_session.participants.add(self.user, other)
+
+        response = self.client.get(reverse('user_chats'))
+        sessions = {session['id']: session for session in response.data}
+
+        last_message = chat_session.messages.order_by('-timestamp', '-id').first()
+        inbox_entry = sessions[chat_session.id]
+        self.assertEqual(inbox_entry['last_message']['id'], last_message.id)
+        self.assertEqual(inbox_entry['last_message']['sender'], 'other_user')
+        self.assertEqual(inbox_entry['unread_count'], 2)
+        self.assertEqual(len(inbox_entry['participants']), 2)
+
+        self.assertIsNone(sessions[empty_session.id]['last_message'])
+        self.assertEqual(sessions[empty_session.id]['unread_count'], 0)
+
+class MarkReadTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='reader')
+        self.other = User.objects.create(username='writer')
+        self.chat_session = create_conversation(self.user, self.other, messages=5)
+        self.message_ids = list(self.chat_session.messages.order_by('id').values_list('id', flat=True))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('chat_session-mark-read', kwargs={'pk': self.chat_session.id})
+
+    def unread_count(self):
+        return self.client.get(reverse('user_chats')).data[0]['unread_count']
+
+    def test_mark_read_up_to_moves_cursor_forward_only(self):
+        self.assertEqual(self.unread_count(), 3)
+
+        response = self.client.post(self.url, {'up_to': self.message_ids[2]})
+        self.assertEqual(response.data['last_read_message_id'], self.message_ids[2])
+        self.assertEqual(self.unread_count(), 1)
+        self.assertEqual(
+            set(Message.objects.filter(read=True).values_list('id', flat=True)), set(self.message_ids[:3:2])
+        )
+
+        response = self.client.post(self.url, {'up_to': self.message_ids[0]})
+        self.assertEqual(response.data['last_read_message_id'], self.message_ids[2])
+
+        self.client.post(self.url)
+        self.assertEqual(self.unread_count(), 0)
+
+    def test_cursor_stops_at_the_latest_message(self):
+        response = self.client.post(self.url, {'up_to': 10 ** 12})
+        self.assertEqual(response.data['last_read_message_id'], self.message_ids[-1])
+        Message.objects.create(chat_session=self.chat_session, sender=self.other, content="new")
+        self.assertEqual(self.unread_count(), 1)
+
+    def test_only_participants_can_mark_read(self):
+        self.client.force_authenticate(User.objects.create(username='outsider'))
+        response = self.client.post(self.url)
+        self.assertEqual(response.status_code, 404)
+
+class ScopedListTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='owner')
+        self.other = User.objects.create(username='someone_else')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_tasks_are_scoped_paginated_and_newest_first(self):
+        for i in range(3):
+            Task.objects.create(user=self.user, task_name=f"task {i}", description="")
+        Task.objects.create(user=self.other, task_name="not mine", description="")
+
+        # COUNT for the paginator, then the page itself
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('task-list'))
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual([task['task_name'] for task in response.data['results']], ["task 2", "task 1", "task 0"])
+
+    def test_messages_are_scoped_to_the_users_sessions(self):
+        create_conversation(self.user, self.other, messages=60)
+        outsider = User.objects.create(username='outsider')
+        create_conversation(self.other, outsider, messages=2)
+
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('messages-list'))
+        self.assertEqual(response.data['count'], 60)
+        self.assertEqual(len(response.data['results']), 50)
+
+    def test_listing_requires_authentication(self):
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get(reverse('task-list')).status_code, 401)
+        self.assertEqual(self.client.get(reverse('messages-list')).status_code, 401)
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='searcher')
+        self.other = User.objects.create(username='friend')
+        self.chat_session = create_conversation(self.user, self.other, messages=0)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, q):
+        response = self.client.get(reverse('messages-search'), {'q': q})
+        self.assertEqual(response.status_code, 200)
+        return [message['content'] for message in response.data['results']]
+
+    def say(self, content, chat_session=None, sender=None):
+        return Message.objects.create(
+            chat_session=chat_session or self.chat_session, sender=sender or self.other, content=content
+        )
+
+    def test_search_is_ranked_and_scoped_to_the_users_sessions(self):
+        self.say("the trainer is running late")
+        self.say("Running running running, see you at the track")
+        self.say("lunch later?")
+        outsider = User.objects.create(username='outsider')
+        elsewhere = create_conversation(self.other, outsider, messages=0)
+        self.say("running alone", chat_session=elsewhere)
+
+        results = self.search('running')
+        self.assertEqual(results, ["Running running running, see you at the track", "the trainer is running late"])
+        self.assertEqual(self.search('RUNNING late'), ["the trainer is running late"])
+        # Search syntax in the query is matched literally
+        self.assertEqual(self.search('late"  OR "lunch'), [])
+
+    def test_index_follows_edits_and_deletes(self):
+        message = self.say("meet at the gym")
+        message.content = "meet at the park"
+        message.save()
+        self.assertEqual(self.search('gym'), [])
+        self.assertEqual(self.search('park'), ["meet at the park"])
+        message.delete()
+        self.assertEqual(self.search('park'), [])
+
+    def test_empty_query_is_rejected(self):
+        self.assertEqual(self.client.get(reverse('messages-search'), {'q': ' '}).status_code, 400)
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='profiled')
+        self.other = User.objects.create(username='profiled_friend')
+        create_conversation(self.user, self.other, messages=3)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_requests_are_exported_as_prometheus_metrics(self):
+        route = 'user_chats'
+        before = metrics.get_histogram('http_request_db_queries', route=route) or {'count': 0, 'sum': 0}
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('user_chats'))
+        after = metrics.get_histogram('http_request_db_queries', route=route)
+        self.assertEqual(after['count'], before['count'] + 1)
+        self.assertEqual(after['sum'] - before['sum'], len(queries))
+        self.assertGreater(metrics.get_histogram('http_request_serializer_duration_seconds', route=route)['sum'], 0)
+
+        with self.settings(METRICS_TOKEN='scrape-me'):
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-me')
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        body = response.content.decode()
+        self.assertIn('# TYPE http_request_duration_seconds histogram', body)
+        self.assertIn(f'http_request_db_queries_count{{route="{route}"}} {after["count"]}', body)
+        self.assertIn('http_request_duration_seconds_bucket{route="user_chats",le="+Inf"}', body)
+
+    def test_metrics_need_the_token_and_a_local_address(self):
+        url = reverse('metrics')
+        # Not served at all until a token is set, even locally (e.g. through a reverse proxy)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        with self.settings(METRICS_TOKEN='scrape-me'):
+            self.assertEqual(self.client.get(url).status_code, 404)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer scrape-me', REMOTE_ADDR='203.0.113.5').status_code, 404)
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer scrape-me').status_code, 200)
+
+    @override_settings(SLOW_REQUEST_MS=0)
+    def test_slow_requests_are_logged_with_their_sql(self):
+        with self.assertLogs('backend.profiling', 'WARNING') as logs:
+            self.client.get(reverse('user_chats'))
+        self.assertIn('Slow http user_chats:', logs.output[0])
+        self.assertIn('FROM "backend_chatsession"', logs.output[0])
+
+class PresenceViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_lists_online_users_among_the_requested_ids(self):
+        user = User.objects.create(username='looking')
+        register(42)
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.get(reverse('presence'), {'ids': '41,42'})
+        self.assertEqual(response.data, {'online': [42]})
+
+        unregister(42)
+        self.assertEqual(client.get(reverse('presence'), {'ids': '42'}).data, {'online': []})
+
+    def test_devices_are_counted(self):
+        self.assertTrue(register(42))
+        self.assertFalse(register(42))
+        self.assertFalse(unregister(42))
+        self.assertEqual(online_user_ids([42]), {42})
+        self.assertTrue(unregister(42))
+        self.assertEqual(online_user_ids([42]), set())
+
+        # An evicted entry is recreated by the next refresh
+        register(42)
+        cache.clear()
+        self.assertTrue(refresh(42))
+        self.assertFalse(refresh(42))
+        self.assertEqual(online_user_ids([42]), {42})
+
+    def test_presence_survives_a_busy_cache(self):
+        register(42)
+        # Profiles, member sets and version stamps share the cache
+        cache.set_many({f"profile:{user_id}": {} for user_id in range(1000)})
+        self.assertEqual(online_user_ids([42]), {42})
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='poller')
+        self.other = User.objects.create(username='friend')
+        self.chat_session = create_conversation(self.user, self.other, messages=2)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def assertRevalidates(self, url, queries):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(queries):
+            not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertNotIn('Last-Modified', response)
+        return response['ETag']
+
+    def test_unchanged_inbox_and_history_answer_304(self):
+        inbox_etag = self.assertRevalidates(reverse('user_chats'), 0)
+        # Only the session lookup runs for the history
+        chat_url = reverse('chat-session', kwargs={'other_user_id': self.other.id})
+        chat_etag = self.assertRevalidates(chat_url, 1)
+
+        save_direct_message(self.other.id, self.user.id, "something new")
+        self.assertEqual(self.client.get(reverse('user_chats'), HTTP_IF_NONE_MATCH=inbox_etag).status_code, 200)
+        # If-Modified-Since is ignored; only the ETag can tell versions a second apart
+        self.assertEqual(
+            self.client.get(reverse('user_chats'), HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT').status_code, 200
+        )
+        self.assertEqual(self.client.get(chat_url, HTTP_IF_NONE_MATCH=chat_etag).status_code, 200)
+
+    def test_reading_and_profile_changes_invalidate_the_inbox(self):
+        inbox_etag = self.assertRevalidates(reverse('user_chats'), 0)
+        self.client.post(reverse('chat_session-mark-read', args=[self.chat_session.id]))
+        response = self.client.get(reverse('user_chats'), HTTP_IF_NONE_MATCH=inbox_etag)
+        self.assertEqual(response.status_code, 200)
+
+        self.other.username = 'renamed'
+        self.other.save()
+        self.assertEqual(self.client.get(reverse('user_chats'), HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+class ChatHistoryPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='reader')
+        self.other = User.objects.create(username='writer')
+        self.chat_session = create_conversation(self.user, self.other, messages=7)
+        self.message_ids = list(self.chat_session.messages.order_by('timestamp', 'id').values_list('id', flat=True))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = reverse('chat-session', kwargs={'other_user_id': self.other.id})
+
+    def get_ids(self, params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return [message['id'] for message in response.data['results']], response.data['has_more']
+
+    def test_without_parameters_returns_full_history(self):
+        response = self.client.get(self.url)
+        self.assertEqual([message['id'] for message in response.data], self.message_ids)
+
+    def test_latest_page_then_older_pages(self):
+        ids, has_more = self.get_ids({'limit': 3})
+        self.assertEqual(ids, self.message_ids[-3:])
+        self.assertTrue(has_more)
+
+        ids, has_more = self.get_ids({'limit': 3, 'before': ids[0]})
+        self.assertEqual(ids, self.message_ids[1:4])
+        self.assertTrue(has_more)
+
+        ids, has_more = self.get_ids({'limit': 3, 'before': ids[0]})
+        self.assertEqual(ids, self.message_ids[:1])
+        self.assertFalse(has_more)
+
+    def test_after_and_since_id(self):
+        ids, has_more = self.get_ids({'limit': 2, 'after': self.message_ids[2]})
+        self.assertEqual(ids, self.message_ids[3:5])
+        self.assertTrue(has_more)
+
+        ids, has_more = self.get_ids({'since_id': self.message_ids[4]})
+        self.assertEqual(ids, self.message_ids[5:])
+        self.assertFalse(has_more)
+
+    def test_unknown_cursor_is_rejected(self):
+        response = self.client.get(self.url, {'before': 0})
+        self.assertEqual(response.status_code, 400)
+
+class DeletionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='leaving')
+        self.other = User.objects.create(username='staying')
+        self.chat_session = create_conversation(self.user, self.other, messages=6)
+        # Logged for replay in both users' event streams
+        self.sent = save_direct_message(self.user.id, self.other.id, "bye", log=True)
+        self.received = save_direct_message(self.other.id, self.user.id, "see you", log=True)
+        Task.objects.create(user=self.user, task_name="run", description="5k")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    @override_settings(DELETE_BATCH_SIZE=2)
+    def test_account_deletion_keeps_the_other_participants_messages(self):
+        response = self.client.delete(reverse('delete-account'))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(User.objects.filter(pk=self.user.pk).exists())
+        self.assertFalse(Task.objects.exists())
+        self.assertEqual(set(self.chat_session.messages.values_list('sender_id', flat=True)), {self.other.id})
+        self.assertEqual(list(self.chat_session.participants.all()), [self.other])
+        # The user's messages are no longer replayed to the others
+        self.assertEqual(list(UserEvent.objects.values_list('user_id', 'message_id')), [(self.other.id, self.received.id)])
+
+    @override_settings(ACCOUNT_DELETE_BACKGROUND_THRESHOLD=2)
+    def test_large_accounts_are_disabled_then_deleted_in_the_background(self):
+        with mock.patch('backend.deletion.run_in_background') as run_in_background:
+            response = self.client.delete(reverse('delete-account'))
+        self.assertEqual(response.status_code, 202)
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.is_active)
+        self.assertIsNotNone(self.user.deleted_at)
+
+        # As if the background task had been interrupted
+        run_in_background.assert_called_once()
+        call_command('purge_deleted_users', stdout=StringIO())
+        self.assertFalse(User.objects.filter(pk=self.user.pk).exists())
+        self.assertEqual(self.chat_session.messages.count(), 4)
+
+    @override_settings(DELETE_BATCH_SIZE=2)
+    def test_session_deletion(self):
+        response = self.client.delete(reverse('chat_session-detail', args=[self.chat_session.id]))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(ChatSession.objects.exists())
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(UserEvent.objects.exists())
+        self.assertTrue(User.objects.filter(pk=self.other.pk).exists())
+
+class DirectSessionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='first')
+        self.other = User.objects.create(username='second')
+
+    def test_get_or_create_is_symmetric(self):
+        chat_session, created = get_or_create_direct_session(self.user.id, self.other.id)
+        self.assertTrue(created)
+        self.assertEqual(chat_session.pair_key, f"{self.user.id}:{self.other.id}")
+        self.assertEqual(set(chat_session.participants.values_list('id', flat=True)), {self.user.id, self.other.id})
+
+        with self.assertNumQueries(1):
+            same_session, created = get_or_create_direct_session(self.other.id, self.user.id)
+        self.assertFalse(created)
+        self.assertEqual(same_session, chat_session)
+
+    def test_unknown_user_is_not_found(self):
+        with self.assertRaises(User.DoesNotExist):
+            get_or_create_direct_session(self.user.id, 987654)
+        self.assertFalse(ChatSession.objects.exists())
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.assertEqual(client.get(reverse('chat-session', args=[987654])).status_code, 404)
+
+    def test_merge_command_folds_duplicates_into_oldest_session(self):
+        third = User.objects.create(username='third')
+        sessions = []
+        for _ in range(3):
+            chat_session = ChatSession.objects.create()
+            chat_session.participants.add(self.user, self.other)
+            Message.objects.create(chat_session=chat_session, sender=self.user, content="hi")
+            sessions.append(chat_session)
+        group_session = ChatSession.objects.create()
+        group_session.participants.add(self.user, self.other, third)
+
+        call_command('merge_chat_sessions', stdout=StringIO())
+
+        keeper = ChatSession.objects.get(pair_key=ChatSession.make_pair_key(self.user.id, self.other.id))
+        self.assertEqual(keeper.id, sessions[0].id)
+        self.assertEqual(keeper.messages.count(), 3)
+        self.assertEqual(set(ChatSession.objects.values_list('id', flat=True)), {keeper.id, group_session.id})
+
+class SaveMessageTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='sender')
+        self.other = User.objects.create(username='recipient')
+        self.chat_session = create_conversation(self.user, self.other, messages=0)
+        # Members are cached from here on, as they are after a session's first message
+        get_member_ids([self.chat_session.id])
+
+    def test_known_session_is_a_single_insert(self):
+        # BEGIN, session lookup, INSERT, COMMIT
+        with self.assertNumQueries(4):
+            message = save_direct_message(self.user.id, self.other.id, "lookup")
+        self.assertEqual(message.chat_session_id, self.chat_session.id)
+
+        with self.assertNumQueries(3):
+            save_direct_message(self.user.id, self.other.id, "cached", self.chat_session.id)
+
+    def test_logged_message_is_one_transaction(self):
+        # BEGIN, INSERT, seq UPDATE, seq SELECT, event INSERT, COMMIT
+        append_user_events([self.user.id, self.other.id], '{"type": "first"}')
+        with self.assertNumQueries(6):
+            message = save_direct_message(self.user.id, self.other.id, "logged", self.chat_session.id, log=True)
+        self.assertEqual(message.seqs, {self.user.id: 2, self.other.id: 2})
+        self.assertEqual(UserEvent.objects.get(user=self.other, seq=2).frame, message.frame_text)
+
+    def test_stale_session_id_is_resolved_again(self):
+        stale_session = ChatSession.objects.create()
+        stale_id = stale_session.id
+        stale_session.delete()
+        message = save_direct_message(self.user.id, self.other.id, "retry", stale_id)
+        self.assertEqual(message.chat_session_id, self.chat_session.id)
+
+class ChatConsumerTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='ws_sender')
+        self.other = User.objects.create(username='ws_recipient')
+
+    def connect(self, user, path=None, **kwargs):
+        application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+        path = path or f"/ws/user/{user.id}/?token={AccessToken.for_user(user)}"
+        return WebsocketCommunicator(application, path, **kwargs)
+
+    async def settle(self, communicator):
+        # Frames are handled in order, so this reply means the connect handler, presence
+        # announcement included, is done and can't pick up a session created afterwards
+        await communicator.send_json_to({'type': 'sync'})
+        await communicator.receive_json_from()
+
+    def test_connection_requires_a_token_for_the_same_user(self):
+        async def scenario():
+            for path in (
+                f"/ws/user/{self.user.id}/",
+                f"/ws/user/{self.user.id}/?token=invalid",
+                f"/ws/user/{self.other.id}/?token={AccessToken.for_user(self.user)}",
+            ):
+                connected, _ = await self.connect(self.user, path).connect()
+                self.assertFalse(connected, path)
+
+            communicator = self.connect(
+                self.user, f"/ws/user/{self.user.id}/", subprotocols=['access_token', str(AccessToken.for_user(self.user))]
+            )
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertEqual(subprotocol, 'access_token')
+            await communicator.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_frames_claiming_another_sender_or_foreign_sessions_are_refused(self):
+        async def scenario():
+            sender = self.connect(self.user)
+            recipient = self.connect(self.other)
+            await sender.connect()
+            await recipient.connect()
+            await sender.send_json_to({
+                'type': 'message', 'senderId': self.other.id, 'recipientId': self.other.id, 'content': "spoofed",
+            })
+            self.assertEqual(await sender.receive_json_from(), {'type': 'error', 'code': 'forbidden_sender', 'event': 'message'})
+            await sender.send_json_to({
+                'type': 'remove-client', 'from_user': self.other.id, 'to_user': self.other.id,
+            })
+            self.assertEqual(await sender.receive_json_from(), {'type': 'error', 'code': 'forbidden_sender', 'event': 'remove-client'})
+            self.assertTrue(await recipient.receive_nothing())
+
+            # Sessions the user isn't in are answered like unknown ones
+            foreign_session = await database_sync_to_async(ChatSession.objects.create)()
+            for chat_session_id in (foreign_session.id, 987654):
+                await sender.send_json_to({'type': 'mark-read', 'chat_session': chat_session_id})
+                self.assertEqual(await sender.receive_json_from(), {
+                    'type': 'error', 'code': 'unknown_session', 'event': 'mark-read', 'field': 'chat_session',
+                })
+            await sender.disconnect()
+            await recipient.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertFalse(Message.objects.exists())
+
+    def test_events_are_profiled(self):
+        before = metrics.get_histogram('ws_event_db_queries', event='message') or {'count': 0, 'sum': 0}
+
+        async def scenario():
+            sender = self.connect(self.user)
+            await sender.connect()
+            await self.settle(sender)
+            await sender.send_json_to({'type': 'message', 'recipientId': self.other.id, 'content': "hello"})
+            await sender.receive_json_from()
+            # The next reply means the message's handler has returned
+            await self.settle(sender)
+            await sender.disconnect()
+
+        async_to_sync(scenario)()
+        after = metrics.get_histogram('ws_event_db_queries', event='message')
+        self.assertEqual(after['count'], before['count'] + 1)
+        self.assertGreater(after['sum'], before['sum'])
+
+    def test_chat_message_is_saved_and_delivered_to_both_users(self):
+        async def scenario():
+            sender = self.connect(self.user)
+            recipient = self.connect(self.other)
+            await sender.connect()
+            await recipient.connect()
+            await self.settle(recipient)
+            delivered = []
+            for content in ("hello", "again"):
+                await sender.send_json_to({
+                    'type': 'message', 'senderId': self.user.id, 'recipientId': self.other.id, 'content': content,
+                })
+                echo = (await sender.receive_json_from())['message']
+                self.assertEqual(echo['content'], content)
+                self.assertEqual((await recipient.receive_json_from())['message'], echo)
+                delivered.append((echo['id'], content))
+            await sender.disconnect()
+            await recipient.disconnect()
+            return delivered
+
+        delivered = async_to_sync(scenario)()
+        chat_session = ChatSession.objects.get()
+        self.assertEqual(list(chat_session.messages.order_by('id').values_list('id', 'content')), delivered)
+
+    def test_mark_read_sends_receipt_to_participants(self):
+        chat_session = create_conversation(self.user, self.other, messages=2)
+        last_message = chat_session.messages.latest('id')
+
+        async def scenario():
+            reader = self.connect(self.other)
+            writer = self.connect(self.user)
+            await reader.connect()
+            await writer.connect()
+            await reader.send_json_to({'type': 'mark-read', 'chat_session': chat_session.id})
+            receipt = await writer.receive_json_from()
+            self.assertEqual(receipt, {'seq': 1, 'type': 'read_receipt', 'data': {
+                'user': self.other.id, 'chat_session': chat_session.id, 'last_read_message_id': last_message.id,
+            }})
+            await reader.disconnect()
+            await writer.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_presence_tracking_and_offline_delivery(self):
+        create_conversation(self.user, self.other, messages=0)
+        offline_frames = []
+        def receiver(sender, user_id, frame, **kwargs):
+            offline_frames.append((user_id, frame['type']))
+        offline_delivery.connect(receiver)
+        self.addCleanup(offline_delivery.disconnect, receiver)
+
+        async def scenario():
+            watcher = self.connect(self.user)
+            await watcher.connect()
+            await watcher.send_json_to({'type': 'message', 'recipientId': self.other.id, 'content': "are you there?"})
+            await watcher.receive_json_from()
+            self.assertEqual(offline_frames, [(self.other.id, 'message')])
+
+            # The first device announces the user, a second one does not
+            phone = self.connect(self.other)
+            tablet = self.connect(self.other)
+            await phone.connect()
+            self.assertEqual(await watcher.receive_json_from(), {'type': 'presence', 'data': {'user': self.other.id, 'online': True}})
+            await tablet.connect()
+            await tablet.send_json_to({'type': 'heartbeat'})
+            self.assertTrue(await watcher.receive_nothing())
+            self.assertEqual(await database_sync_to_async(online_user_ids)([self.user.id, self.other.id]), {self.user.id, self.other.id})
+
+            await phone.disconnect()
+            self.assertTrue(await watcher.receive_nothing())
+            await tablet.disconnect()
+            self.assertEqual(await watcher.receive_json_from(), {'type': 'presence', 'data': {'user': self.other.id, 'online': False}})
+            await watcher.disconnect()
+
+        async_to_sync(scenario)()
+
+    @override_settings(PRESENCE_TTL=1)
+    def test_connections_stay_online_and_catch_up_after_eviction(self):
+        async def scenario():
+            sender = self.connect(self.user)
+            recipient = self.connect(self.other)
+            await sender.connect()
+            await recipient.connect()
+            await self.settle(recipient)
+            # Longer than the TTL, without heartbeats from the clients
+            await asyncio.sleep(1.5)
+            self.assertEqual(await database_sync_to_async(online_user_ids)([self.user.id, self.other.id]), {self.user.id, self.other.id})
+
+            for content in ("after the TTL", "after eviction"):
+                await sender.send_json_to({'type': 'message', 'recipientId': self.other.id, 'content': content})
+                for communicator in (sender, recipient):
+                    frame = await communicator.receive_json_from()
+                    while frame['type'] == 'presence':
+                        # Announced again when the evicted entry is recreated
+                        frame = await communicator.receive_json_from()
+                    self.assertEqual(frame['message']['content'], content)
+                # The recipient's next refresh recreates its entry and replays what it missed
+                await database_sync_to_async(cache.clear)()
+            await sender.disconnect()
+            await recipient.disconnect()
+
+        async_to_sync(scenario)()
+
+    @override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_BATCH_SIZE=3, CHAT_WRITE_BEHIND_FLUSH_INTERVAL=60)
+    def test_write_behind_flushes_full_batches_and_drains_on_disconnect(self):
+        frames = []
+
+        async def scenario():
+            sender = self.connect(self.user)
+            await sender.connect()
+            for i in range(4):
+                await sender.send_json_to({
+                    'type': 'message', 'senderId': self.user.id, 'recipientId': self.other.id, 'content': str(i),
+                })
+                frames.append(await sender.receive_json_from())
+            # The first full batch is written without waiting for the flush interval
+            for _ in range(50):
+                if await database_sync_to_async(Message.objects.count)() == 3:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(await database_sync_to_async(Message.objects.count)(), 3)
+            await sender.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(list(Message.objects.order_by('id').values_list('content', flat=True)), ["0", "1", "2", "3"])
+        # Broadcast with the uuid of the row, which is logged for both users with its id
+        messages = list(Message.objects.order_by('id'))
+        self.assertEqual([frame['message']['uuid'] for frame in frames], [str(message.uuid) for message in messages])
+        self.assertNotIn('id', frames[0]['message'])
+        for user in (self.user, self.other):
+            logged = [json.loads(frame)['message'] for frame in UserEvent.objects.filter(user=user).order_by('seq').values_list('frame', flat=True)]
+            self.assertEqual([(message['id'], message['uuid']) for message in logged], [(message.id, str(message.uuid)) for message in messages])
+
+    @override_settings(CHAT_WRITE_BEHIND=True, CHAT_WRITE_BEHIND_BATCH_SIZE=2, CHAT_WRITE_BEHIND_FLUSH_INTERVAL=60)
+    def test_write_behind_resolves_sessions_deleted_meanwhile(self):
+        async def scenario():
+            sender = self.connect(self.user)
+            await sender.connect()
+            for content in ("before", "cached"):
+                await sender.send_json_to({'type': 'message', 'recipientId': self.other.id, 'content': content})
+                await sender.receive_json_from()
+            for _ in range(50):
+                if await database_sync_to_async(Message.objects.count)() == 2:
+                    break
+                await asyncio.sleep(0.01)
+            chat_session = await database_sync_to_async(ChatSession.objects.get)()
+            await database_sync_to_async(delete_chat_session)(chat_session)
+
+            # The connection still has the deleted session's id
+            for content in ("after", "and after"):
+                await sender.send_json_to({'type': 'message', 'recipientId': self.other.id, 'content': content})
+                await sender.receive_json_from()
+            await sender.disconnect()
+
+        with self.assertLogs('backend.writer', 'ERROR') as logs:
+            async_to_sync(scenario)()
+        self.assertFalse([line for line in logs.output if 'Dropping' in line])
+        chat_session = ChatSession.objects.get()
+        self.assertEqual(
+            list(chat_session.messages.order_by('id').values_list('content', flat=True)), ["after", "and after"]
+        )
+
+    def test_malformed_frames_get_error_replies_and_relays_keep_working(self):
+        async def scenario():
+            sender = self.connect(self.user)
+            recipient = self.connect(self.other)
+            await sender.connect()
+            await recipient.connect()
+            await sender.send_to(text_data="not json")
+            self.assertEqual(await sender.receive_json_from(), {'type': 'error', 'code': 'invalid_json', 'event': None})
+            await sender.send_json_to({'type': 'no-such-event'})
+            self.assertEqual(await sender.receive_json_from(), {'type': 'error', 'code': 'unknown_event', 'event': 'no-such-event'})
+            await sender.send_json_to({'type': 'message', 'recipientId': self.other.id})
+            self.assertEqual(await sender.receive_json_from(), {
+                'type': 'error', 'code': 'missing_field', 'event': 'message', 'field': 'content',
+            })
+            await sender.send_json_to({'type': 'trainer-request-accepted', 'id': 'seven', 'to_user': self.other.id})
+            self.assertEqual(await sender.receive_json_from(), {
+                'type': 'error', 'code': 'invalid_field', 'event': 'trainer-request-accepted', 'field': 'id',
+            })
+            # Out of range for the database's integer columns
+            await sender.send_json_to({'type': 'message', 'recipientId': 10 ** 20, 'content': "x"})
+            self.assertEqual(await sender.receive_json_from(), {
+                'type': 'error', 'code': 'invalid_field', 'event': 'message', 'field': 'recipientId',
+            })
+            await sender.send_json_to({'type': 'mark-read', 'chat_session': str(10 ** 20)})
+            self.assertEqual(await sender.receive_json_from(), {
+                'type': 'error', 'code': 'invalid_field', 'event': 'mark-read', 'field': 'chat_session',
+            })
+
+            await sender.send_json_to({'type': 'trainer-request-accepted', 'id': 7, 'to_user': str(self.other.id), 'extra': 1})
+            frame = await recipient.receive_json_from()
+            self.assertEqual(frame['type'], 'trainer_request_accepted')
+            self.assertEqual(frame['data'], {'id': 7, 'to_user': self.other.id, 'from_user': self.user.id})
+            await sender.disconnect()
+            await recipient.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_msgpack_with_deflate_is_negotiated_per_connection(self):
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        decompressor = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+        def pack(frame):
+            return (compressor.compress(msgpack.packb(frame)) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+        def unpack(data):
+            return msgpack.unpackb(decompressor.decompress(data + b'\x00\x00\xff\xff'))
+
+        async def scenario():
+            token = AccessToken.for_user(self.user)
+            sender = self.connect(self.user, path=f"/ws/user/{self.user.id}/?token={token}", subprotocols=['omw.msgpack+deflate'])
+            connected, subprotocol = await sender.connect()
+            self.assertEqual(subprotocol, 'omw.msgpack+deflate')
+            recipient = self.connect(self.other)
+            await recipient.connect()
+            await self.settle(recipient)
+
+            for content in ("first", "second"):
+                await sender.send_to(bytes_data=pack({'type': 'message', 'recipientId': self.other.id, 'content': content}))
+                echo = unpack(await sender.receive_from())
+                self.assertEqual(echo['message']['content'], content)
+                # JSON clients get the same frame as text
+                self.assertEqual((await recipient.receive_json_from())['message']['content'], content)
+            await sender.disconnect()
+            await recipient.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(Message.objects.count(), 2)
+
+    @override_settings(CHAT_REPLAY_LIMIT=3)
+    def test_reconnect_replays_missed_events_or_asks_for_resync(self):
+        async def scenario():
+            sender = self.connect(self.other)
+            await sender.connect()
+            for i in range(4):
+                await sender.send_json_to({'type': 'message', 'recipientId': self.user.id, 'content': str(i)})
+                await sender.receive_json_from()
+
+            # Missed events 3 and 4 are replayed in order, then live events continue the stream
+            communicator = self.connect(self.user, path=f"/ws/user/{self.user.id}/?last_seq=2&token={AccessToken.for_user(self.user)}")
+            await communicator.connect()
+            replayed = [await communicator.receive_json_from() for _ in range(2)]
+            self.assertEqual([(frame['seq'], frame['message']['content']) for frame in replayed], [(3, "2"), (4, "3")])
+            await sender.send_json_to({'type': 'message', 'recipientId': self.user.id, 'content': "live"})
+            self.assertEqual((await communicator.receive_json_from())['seq'], 5)
+            await communicator.disconnect()
+
+            # More missed events than CHAT_REPLAY_LIMIT
+            communicator = self.connect(self.user, path=f"/ws/user/{self.user.id}/?last_seq=1&token={AccessToken.for_user(self.user)}")
+            await communicator.connect()
+            self.assertEqual(await communicator.receive_json_from(), {'type': 'resync', 'data': {'seq': 5}})
+            await communicator.disconnect()
+            await sender.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_live_frames_are_only_deduplicated_against_the_replay(self):
+        consumer = ChatConsumer()
+        consumer.user_id = self.user.id
+        consumer.send_queue = SendQueue(10, 'coalesce')
+        consumer.replayed_up_to = consumer.delivered_seq = 2
+
+        async def scenario():
+            # Concurrent senders can be delivered out of seq order
+            for seq in (2, 4, 3):
+                await consumer.forward_frame({'text': '{"type": "x"}', 'seqs': {str(self.user.id): seq}})
+            return [json.loads(text)['seq'] for _, text in consumer.send_queue.frames]
+
+        self.assertEqual(async_to_sync(scenario)(), [4, 3])
+
+    def test_unknown_recipients_get_error_replies(self):
+        async def scenario():
+            sender = self.connect(self.user)
+            await sender.connect()
+            await sender.send_json_to({'type': 'trainer-request-accepted', 'id': 1, 'to_user': 987654})
+            self.assertEqual(await sender.receive_json_from(), {
+                'type': 'error', 'code': 'unknown_user', 'event': 'trainer-request-accepted', 'field': 'to_user',
+            })
+            await sender.send_json_to({'type': 'message', 'recipientId': 987654, 'content': "anyone?"})
+            self.assertEqual(await sender.receive_json_from(), {
+                'type': 'error', 'code': 'unknown_user', 'event': 'message', 'field': 'recipientId',
+            })
+            # The connection keeps working
+            await sender.send_json_to({'type': 'message', 'recipientId': self.other.id, 'content': "hello"})
+            self.assertEqual((await sender.receive_json_from())['message']['content'], "hello")
+            await sender.disconnect()
+
+        async_to_sync(scenario)()
+        self.assertEqual(list(Message.objects.values_list('content', flat=True)), ["hello"])
+        self.assertFalse(UserEvent.objects.filter(user_id=987654).exists())
+
+    @override_settings(CHAT_RATE_LIMITS={'heartbeat': (0.001, 2), 'default': (0.001, 1)}, CHAT_MAX_FRAME_BYTES=200)
+    def test_throttled_and_oversized_frames_get_error_replies(self):
+        async def scenario():
+            communicator = self.connect(self.user)
+            await communicator.connect()
+            for _ in range(3):
+                await communicator.send_json_to({'type': 'heartbeat'})
+            self.assertEqual(await communicator.receive_json_from(), {'type': 'error', 'code': 'rate_limited', 'event': 'heartbeat'})
+            await communicator.send_json_to({'type': 'message', 'recipientId': self.other.id, 'content': 'x' * 500})
+            self.assertEqual(await communicator.receive_json_from(), {'type': 'error', 'code': 'frame_too_large'})
+            # Unregistered types share the default bucket, and its counter
+            for event_type in ('made-up-1', 'made-up-2', 'made-up-3'):
+                await communicator.send_json_to({'type': event_type})
+                await communicator.receive_json_from()
+            await communicator.disconnect()
+
+        throttled = metrics.get_counter('ws_frames_throttled_total', bucket='heartbeat')
+        throttled_default = metrics.get_counter('ws_frames_throttled_total', bucket='default')
+        async_to_sync(scenario)()
+        self.assertEqual(metrics.get_counter('ws_frames_throttled_total', bucket='heartbeat'), throttled + 1)
+        self.assertEqual(metrics.get_counter('ws_frames_throttled_total', bucket='default'), throttled_default + 2)
+        self.assertNotIn('made-up', metrics.render())
+        self.assertFalse(Message.objects.exists())
+
+class DatabaseSettingsTests(TestCase):
+    def test_sqlite_connections_are_tuned_on_connect(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest("SQLite only")
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 20000)
+        self.assertEqual(connection.transaction_mode, 'IMMEDIATE')
+
+class BenchmarkHarnessTests(TestCase):
+    def test_seed_chat_data_creates_users_with_contacts_and_messages(self):
+        out = StringIO()
+        call_command('seed_chat_data', '--users=20', '--contacts=3', '--messages=100', stdout=out)
+        report = json.loads(out.getvalue())
+
+        self.assertEqual(report['users'], 20)
+        self.assertEqual(Message.objects.count(), 100)
+        self.assertEqual(ChatSession.objects.count(), report['sessions'])
+        self.assertEqual(len(report['pairs']), 20)
+        user_id, contact_id = report['pairs'][0]
+        session = ChatSession.objects.get(pair_key=ChatSession.make_pair_key(user_id, contact_id))
+        self.assertEqual(set(session.participants.values_list('id', flat=True)), {user_id, contact_id})
+        self.assertTrue(User.objects.get(id=user_id).check_password(BENCH_PASSWORD))
+
+    def test_regressions_against_the_baseline_are_reported(self):
+        baseline = {'ws': [{'clients': 10, 'p50_ms': 10.0, 'p99_ms': 20.0, 'messages_per_second': 100.0}]}
+        within = {'ws': [{'clients': 10, 'p50_ms': 12.0, 'p99_ms': 90.0, 'messages_per_second': 80.0}]}
+        self.assertEqual(compare_results(within, baseline, tolerance=0.3), [])
+
+        worse = {'ws': [{'clients': 10, 'p50_ms': 14.0, 'p99_ms': 20.0, 'messages_per_second': 60.0}]}
+        self.assertEqual(compare_results(worse, baseline, tolerance=0.3), [
+            "ws[0].messages_per_second: 100.0 -> 60.0 per second",
+            "ws[0].p50_ms: 10.0 -> 14.0 ms",
+        ])
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ImportChatDataTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        cache.clear()
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_imports_users_sessions_participants_and_messages(self):
+        users = self.write('users.jsonl', '\n'.join(json.dumps(row) for row in [
+            {'id': 501, 'username': 'hashed', 'password': make_password('kept')},
+            {'id': 502, 'username': 'plain', 'password': 'hashed here', 'guest': True},
+            {'id': 503, 'username': 'default'},
+        ]) + '\n')
+        sessions = self.write('sessions.csv', 'id,pair_key,created_at\n701,501:502,2024-01-01T10:00:00\n702,,\n')
+        participants = self.write('participants.csv', 'chat_session,user\n701,501\n701,502\n702,502\n702,503\n')
+        messages = self.write('messages.jsonl', ''.join(
+            json.dumps({'chat_session': 701, 'sender': 501 + i % 2, 'content': f"imported {i}", 'read': 'true'}) + '\n'
+            for i in range(5)
+        ))
+        # Cached before the import, which sends no signals
+        self.assertEqual(get_member_ids([701]), {701: []})
+        version = get_version(chat_version_key(701))
+
+        out = StringIO()
+        call_command(
+            'import_chat_data', users=users, sessions=sessions, participants=participants, messages=messages,
+            password='fallback', batch_size=2, stdout=out,
+        )
+
+        self.assertIn('messages: 5 rows in', out.getvalue())
+        self.assertIn('rows/s', out.getvalue())
+        self.assertTrue(User.objects.get(id=501).check_password('kept'))
+        self.assertTrue(User.objects.get(id=502).check_password('hashed here'))
+        self.assertTrue(User.objects.get(id=502).guest)
+        self.assertTrue(User.objects.get(id=503).check_password('fallback'))
+        self.assertEqual(ChatSession.objects.get(id=701).pair_key, '501:502')
+        self.assertIsNone(ChatSession.objects.get(id=702).pair_key)
+        self.assertEqual(sorted(get_member_ids([701])[701]), [501, 502])
+        self.assertEqual(Message.objects.filter(chat_session_id=701, read=True).count(), 5)
+        self.assertGreater(get_version(chat_version_key(701)), version)
+
+    def test_bad_rows_are_reported_with_their_position(self):
+        users = self.write('users.csv', 'id,username\n1,fine\nnot-a-number,broken\n')
+        with self.assertRaisesMessage(CommandError, 'users.csv, row 2'):
+            call_command('import_chat_data', users=users, stdout=StringIO())
+
+class SendQueueTests(TestCase):
+    def drain(self, queue):
+        return [queue.frames.popleft()[1] for _ in range(len(queue.frames))]
+
+    def test_drop_oldest(self):
+        queue = SendQueue(2, 'drop_oldest')
+        for text in ('a', 'b', 'c'):
+            self.assertTrue(queue.put(text))
+        self.assertEqual(self.drain(queue), ['b', 'c'])
+
+    def test_coalesce_replaces_the_stale_frame_with_the_same_key(self):
+        queue = SendQueue(2, 'coalesce')
+        queue.put('offline', 'presence:1')
+        queue.put('message')
+        queue.put('online', 'presence:1')
+        self.assertEqual(self.drain(queue), ['online', 'message'])
+
+    def test_disconnect_refuses_frames_once_full(self):
+        queue = SendQueue(1, 'disconnect')
+        self.assertTrue(queue.put('a'))
+        self.assertFalse(queue.put('b'))
+
+class GroupSendManyTests(TestCase):
+    def test_channel_in_several_groups_receives_one_copy(self):
+        async def scenario():
+            layer = InMemoryChannelLayer()
+            channel = await layer.new_channel()
+            other_channel = await layer.new_channel()
+            await layer.group_add('user_1', channel)
+            await layer.group_add('user_2', channel)
+            await layer.group_add('user_2', other_channel)
+
+            await group_send_many(layer, ['user_1', 'user_2'], {'type': 'forward_frame', 'text': 'frame'})
+            self.assertEqual((await layer.receive(channel))['text'], 'frame')
+            self.assertEqual((await layer.receive(other_channel))['text'], 'frame')
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(layer.receive(channel), 0.05)
+
+        async_to_sync(scenario)()
+
+class ProfilePictureTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, BACKGROUND_TASKS_EAGER=True)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.user = User.objects.create(username='avatar')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, size=(600, 400)):
+        buffer = BytesIO()
+        Image.new('RGB', size, 'red').save(buffer, format='JPEG')
+        buffer.seek(0)
+        picture = SimpleUploadedFile('avatar.jpg', buffer.read(), content_type='image/jpeg')
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('upload_profile_picture'), {'profile_picture': picture}, format='multipart')
+
+    def test_upload_crops_original_and_writes_thumbnails(self):
+        self.assertEqual(self.upload().status_code, 200)
+        self.user.refresh_from_db()
+        with Image.open(self.user.profile_picture.path) as img:
+            self.assertEqual(img.size, (400, 400))
+        for size in THUMBNAIL_SIZES:
+            with Image.open(os.path.join(self.media_root, thumbnail_name(self.user.profile_picture.name, size))) as img:
+                self.assertEqual(img.size, (size, size))
+
+    def test_saving_without_a_new_picture_skips_processing(self):
+        self.upload()
+        self.user.refresh_from_db()
+        with mock.patch('backend.models.run_in_background') as run:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user.username = 'renamed'
+                self.user.save()
+        run.assert_not_called()
+
+    def test_oversized_pictures_are_rejected(self):
+        self.assertEqual(self.upload(size=(4001, 10)).status_code, 400)
+
+    def test_inbox_references_the_thumbnail(self):
+        self.upload()
+        self.user.refresh_from_db()
+        create_conversation(self.user, User.objects.create(username='friend'))
+        participants = self.client.get(reverse('user_chats')).data[0]['participants']
+        picture = next(participant['profile_picture'] for participant in participants if participant['id'] == self.user.id)
+        self.assertTrue(picture.endswith(thumbnail_name(self.user.profile_picture.name, 96)))
+
+class GuestUserCreateTests(TestCase):
+    def setUp(self):
+        self.bot = User.objects.create(username='welcome_bot')
+        settings_override = override_settings(WELCOME_BOT_USER_ID=self.bot.id)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_guest_gets_tokens_and_welcome_conversation(self):
+        with mock.patch('django.contrib.auth.hashers.get_hasher') as get_hasher:
+            response = APIClient().post(reverse('create_guest_user'))
+        self.assertEqual(response.status_code, 201)
+        get_hasher.assert_not_called()
+
+        token = AccessToken(response.data['tokens']['access'])
+        guest = User.objects.get(id=token['user_id'])
+        self.assertEqual(token['username'], guest.username)
+        self.assertTrue(guest.guest)
+        self.assertFalse(guest.has_usable_password())
+
+        chat_session = ChatSession.objects.get(pair_key=ChatSession.make_pair_key(guest.id, self.bot.id))
+        self.assertEqual(set(chat_session.participants.values_list('id', flat=True)), {guest.id, self.bot.id})
+        self.assertEqual(chat_session.messages.get().sender_id, self.bot.id)
@@ -0,0 +1,83 @@
+import asyncio
+import time
+from collections import deque
+from . import metrics
+
+SEND_QUEUE_POLICIES = ('drop_oldest', 'coalesce', 'disconnect')
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def consume(self, amount=1):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+
+class RateLimiter:
+    """
+    Per-connection token buckets by event type.
+    limits maps an event type to (tokens per second, burst); 'default' covers the rest.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.buckets = {}
+
+    def bucket_key(self, event_type):
+        return event_type if event_type in self.limits else 'default'
+
+    def allow(self, event_type):
+        key = self.bucket_key(event_type)
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(*self.limits[key])
+        return self.buckets[key].consume()
+
+
+class SendQueue:
+    """
+    Bounded queue of encoded frames waiting to be written to one WebSocket.
+    When it is full the policy decides what gives:
+    - drop_oldest: the oldest queued frame is dropped.
+    - coalesce: a queued frame with the same coalesce key (e.g. an older presence update
+      for the same user) is replaced by the new one; otherwise the oldest is dropped.
+    - disconnect: put() returns False and the consumer closes the slow connection.
+    """
+
+    def __init__(self, maxsize, policy):
+        assert policy in SEND_QUEUE_POLICIES, f"Unknown send queue policy {policy}"
+        self.maxsize = maxsize
+        self.policy = policy
+        self.frames = deque()
+        self.ready = asyncio.Event()
+
+    def put(self, text, coalesce_key=None):
+        if len(self.frames) >= self.maxsize:
+            if self.policy == 'disconnect':
+                return False
+            if self.policy == 'coalesce' and coalesce_key is not None:
+                for index, (key, _) in enumerate(self.frames):
+                    if key == coalesce_key:
+                        self.frames[index] = (coalesce_key, text)
+                        metrics.increment('ws_frames_dropped_total', reason='coalesced')
+                        return True
+            self.frames.popleft()
+            metrics.increment('ws_frames_dropped_total', reason='queue_full')
+        self.frames.append((coalesce_key, text))
+        self.ready.set()
+        return True
+
+    async def get(self):
+        while not self.frames:
+            self.ready.clear()
+            await self.ready.wait()
+        return self.frames.popleft()[1]
@@ -3,7 +3,7 @@ from rest_framework.routers import DefaultRouter
 from . import views
 from .views import (UserViewSet)
 from .views import (UserViewSet, UserRegistrationView, UserDeleteAPIView, UserChatSessionsView,ChatSessionViewSet, MessageViewSet,
-GuestUserCreateAPIView, ProfilePictureUploadView, TaskViewSet)
+GuestUserCreateAPIView, ProfilePictureUploadView, TaskViewSet, PresenceView)
 from rest_framework_simplejwt.views import TokenRefreshView
 from .views import MyTokenObtainPairView
 
@@ -24,4 +24,6 @@ urlpatterns = [
     path('delete-account/', UserDeleteAPIView.as_view(), name='delete-account'),
     path('upload_profile_picture/', ProfilePictureUploadView.as_view(), name='upload_profile_picture'),
     path('api/guest/create/', GuestUserCreateAPIView.as_view(), name='create_guest_user'),
+    path('presence/', PresenceView.as_view(), name='presence'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
@@ -1,19 +1,208 @@
-from .models import (ChatSession)
+import json
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, OuterRef, Subquery, IntegerField
+from django.db.models.functions import Coalesce
+from .caching import bump_versions, get_member_ids, get_session_profiles
+from .models import (User, ChatSession, Message, ChatReadCursor, EventSequence, UserEvent)
+
+def get_or_create_direct_session(user_id_a, user_id_b):
+    # Shared by the REST views and the WebSocket consumer. The unique pair_key turns
+    # concurrent first messages into a single session instead of duplicates. Raises
+    # User.DoesNotExist when either user doesn't exist.
+    pair_key = ChatSession.make_pair_key(user_id_a, user_id_b)
+    try:
+        return ChatSession.objects.get(pair_key=pair_key), False
+    except ChatSession.DoesNotExist:
+        pass
+
+    # Checked up front: a foreign key failure would look like a lost race below, and
+    # SQLite only reports it when the outermost transaction commits
+    user_ids = {int(user_id_a), int(user_id_b)}
+    if User.objects.filter(id__in=user_ids).count() < len(user_ids):
+        raise User.DoesNotExist(f"No user {user_id_a} or {user_id_b}")
+
+    try:
+        with transaction.atomic():
+            chat_session = ChatSession.objects.create(pair_key=pair_key)
+            chat_session.participants.add(user_id_a, user_id_b)
+        return chat_session, True
+    except IntegrityError:
+        # Another request created it between our lookup and insert
+        return ChatSession.objects.get(pair_key=pair_key), False
+
+def save_direct_message(sender_id, recipient_id, content, chat_session_id=None, log=False):
+    # Resolves the session and inserts the message by id in one transaction, without
+    # loading either User row. Pass a known chat_session_id to skip the lookup. With log,
+    # the message's frame gets its seq in both users' event streams in the same
+    # transaction, and is left on the message as frame_text, with seqs.
+    try:
+        with transaction.atomic():
+            session_id = chat_session_id
+            if session_id is None:
+                chat_session, created = get_or_create_direct_session(sender_id, recipient_id)
+                session_id = chat_session.id
+            message = Message.objects.create(chat_session_id=session_id, sender_id=sender_id, content=content)
+            if log:
+                message.frame_text = json.dumps(message_frame(message, recipient_id))
+                message.seqs = append_user_events([sender_id, recipient_id], message.frame_text, message.id)
+            return message
+    except IntegrityError:
+        if chat_session_id is None:
+            raise
+        # The cached session was deleted, resolve it again
+        return save_direct_message(sender_id, recipient_id, content, log=log)
+
+def message_frame(message, recipient_id):
+    # Every message carries its uuid; saved ones also their id, which clients pass to
+    # /chat/<id>/?since_id= to catch up
+    frame = {
+        'type': 'message',
+        'message': {
+            'uuid': str(message.uuid),
+            'sender': message.sender_id,
+            'recipient': int(recipient_id),
+            'content': message.content,
+            'timestamp': message.timestamp.isoformat(),
+        },
+    }
+    if message.id is not None:
+        frame['message']['id'] = message.id
+    return frame
 
 def get_chat_session(user_id_a, user_id_b):
-    chat_sessions = ChatSession.objects.filter(
-        participants__id=user_id_a
-    ).filter(
-        participants__id=user_id_b
-    )
-    
-    if chat_sessions.exists():
-        return chat_sessions.first()
-    else:
-        chat_session = ChatSession.objects.create()
-        chat_session.participants.add(user_id_a, user_id_b)
-        chat_session.save()
-        return chat_session
+    chat_session, created = get_or_create_direct_session(user_id_a, user_id_b)
+    return chat_session
     
 def get_messages_for_session(chat_session):
-    return chat_session.messages.all().order_by('timestamp')
\ No newline at end of file
+    return chat_session.messages.all().order_by('timestamp', 'id')
+
+def mark_session_read(user_id, chat_session_id, up_to=None):
+    # Moves the user's read cursor forward (never back) to up_to, or to the latest message.
+    # Returns the cursor position and the session's participant ids.
+    participant_ids = get_member_ids([chat_session_id])[int(chat_session_id)]
+    if int(user_id) not in participant_ids:
+        raise ChatSession.DoesNotExist
+
+    # Never past the latest message, or messages sent later would never count as unread
+    latest = Message.objects.filter(chat_session_id=chat_session_id).order_by('-id').values_list('id', flat=True).first() or 0
+    up_to = latest if up_to is None else min(up_to, latest)
+
+    with transaction.atomic():
+        cursor, created = ChatReadCursor.objects.get_or_create(
+            user_id=user_id, chat_session_id=chat_session_id, defaults={'last_read_message_id': up_to}
+        )
+        if not created and cursor.last_read_message_id < up_to:
+            cursor.last_read_message_id = up_to
+            cursor.save(update_fields=['last_read_message_id', 'updated_at'])
+        # Keep the per-message flag in step for clients that still display it, in one UPDATE
+        Message.objects.filter(
+            chat_session_id=chat_session_id, id__lte=cursor.last_read_message_id, read=False
+        ).exclude(sender_id=user_id).update(read=True)
+        bump_versions([chat_session_id])
+    return cursor.last_read_message_id, participant_ids
+
+def get_contact_ids(user_id):
+    # Everyone the user shares a chat session with
+    Participant = ChatSession.participants.through
+    return list(
+        Participant.objects.filter(
+            chatsession__participants=user_id
+        ).exclude(user_id=user_id).values_list('user_id', flat=True).distinct()
+    )
+
+def read_receipt_frame(user_id, chat_session_id, last_read_message_id):
+    return {
+        'type': 'read_receipt',
+        'data': {
+            'user': int(user_id),
+            'chat_session': int(chat_session_id),
+            'last_read_message_id': last_read_message_id,
+        },
+    }
+
+def append_user_events(user_ids, text, message_id=None):
+    # Gives the encoded frame the next sequence number in each user's event stream and
+    # logs it for replay, tied to message_id when it carries a message. Returns {user_id: seq}. Updating the counters first takes the
+    # write lock, so concurrent appends can't hand out the same number. Raises
+    # User.DoesNotExist, logging nothing, when one of the users doesn't exist.
+    user_ids = sorted({int(user_id) for user_id in user_ids})
+    if not user_ids:
+        return {}
+    # No savepoint inside a caller's transaction (save_direct_message): it fails as a whole
+    with transaction.atomic(savepoint=False):
+        sequences = EventSequence.objects.filter(user_id__in=user_ids)
+        if sequences.update(last_seq=F('last_seq') + 1) < len(user_ids):
+            # First events for some of the users, which are checked here rather than left
+            # to a foreign key failure when the outermost transaction commits
+            missing = set(user_ids) - set(sequences.values_list('user_id', flat=True))
+            if User.objects.filter(id__in=missing).count() < len(missing):
+                raise User.DoesNotExist(f"No user among {sorted(missing)}")
+            EventSequence.objects.bulk_create(
+                [EventSequence(user_id=user_id, last_seq=0) for user_id in missing], ignore_conflicts=True
+            )
+            EventSequence.objects.filter(user_id__in=missing).update(last_seq=F('last_seq') + 1)
+        seqs = dict(sequences.values_list('user_id', 'last_seq'))
+        UserEvent.objects.bulk_create([
+            UserEvent(user_id=user_id, seq=seq, frame=text, message_id=message_id) for user_id, seq in seqs.items()
+        ])
+    return seqs
+
+def get_event_seq(user_id):
+    # The last seq handed out in the user's event stream
+    return EventSequence.objects.filter(user_id=user_id).values_list('last_seq', flat=True).first() or 0
+
+def get_missed_events(user_id, last_seq, limit):
+    # The user's logged frames after last_seq as (seq, frame) pairs, or None when they
+    # can't all be replayed (pruned from the log, or more than limit) and the client
+    # has to resync. Frames of deleted messages leave gaps in the seqs. Also returns the
+    # stream's current seq.
+    current = get_event_seq(user_id)
+    if last_seq == current:
+        return [], current
+    if last_seq > current or current - last_seq > limit:
+        return None, current
+    events = list(
+        UserEvent.objects.filter(user_id=user_id, seq__gt=last_seq).order_by('seq').values_list('seq', 'frame')[:limit]
+    )
+    if not events or events[0][0] != last_seq + 1:
+        return None, current
+    return events, current
+
+def get_inbox_sessions(user):
+    # One query for the sessions (last message id and unread count are correlated
+    # subqueries) and one for the last messages, no matter how many conversations the
+    # user has. Participants come from the profile cache.
+    last_message = Message.objects.filter(
+        chat_session=OuterRef('pk')
+    ).order_by('-timestamp', '-id').values('id')[:1]
+
+    last_read = ChatReadCursor.objects.filter(
+        chat_session=OuterRef('pk'), user=user
+    ).values('last_read_message_id')[:1]
+
+    # Unread means newer than the user's read cursor, counted on the (chat_session, id) index
+    unread_count = Message.objects.filter(
+        chat_session=OuterRef('pk'), id__gt=OuterRef('last_read_message_id')
+    ).exclude(
+        sender=user
+    ).order_by().values('chat_session').annotate(count=Count('id')).values('count')
+
+    chat_sessions = list(
+        ChatSession.objects.filter(participants=user)
+        .annotate(
+            last_message_id=Subquery(last_message),
+            last_read_message_id=Coalesce(Subquery(last_read), 0),
+        )
+        .annotate(
+            unread_count=Coalesce(Subquery(unread_count, output_field=IntegerField()), 0),
+        )
+    )
+
+    last_messages = Message.objects.in_bulk(
+        [session.last_message_id for session in chat_sessions if session.last_message_id]
+    )
+    participant_profiles = get_session_profiles([session.id for session in chat_sessions])
+    for session in chat_sessions:
+        session.inbox_last_message = last_messages.get(session.last_message_id)
+        session.participant_profiles = participant_profiles[session.id]
+    return chat_sessions
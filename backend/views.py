@@ -1,19 +1,40 @@
+import hmac
+import json
+import logging
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from django.utils.cache import get_conditional_response
 from rest_framework_simplejwt.views import TokenObtainPairView
-from rest_framework_simplejwt.tokens import RefreshToken
 from .serializers import (MyTokenObtainPairSerializer, UserSerializer, UserRegistrationSerializer, MessageSerializer, ChatSessionSerializer, 
-GuestRegistrationSerializer, TaskSerializer)
+GuestRegistrationSerializer, TaskSerializer, InboxChatSessionSerializer)
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from .models import (User, Message, ChatSession, Task)
 from rest_framework import status
 from rest_framework import viewsets
+from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
-from .utils import get_chat_session, get_messages_for_session
+from . import metrics
+from .caching import bump_versions, chat_version_key, get_version, inbox_version_key
+from .deletion import delete_chat_session, request_user_deletion
+from .layers import send_to_users
+from .presence import online_user_ids
+from .search import search_messages
+from .pagination import MessageKeysetPagination, DefaultPagination
+from .utils import (get_chat_session, get_messages_for_session, get_inbox_sessions, mark_session_read, read_receipt_frame,
+append_user_events)
 
 # Create your views here.
 
+logger = logging.getLogger(__name__)
+
+MAX_PRESENCE_IDS = 500
+
 def get_tokens_for_user(user):
-    refresh = RefreshToken.for_user(user)
+    # Same claims as the tokens issued by MyTokenObtainPairView
+    refresh = MyTokenObtainPairSerializer.get_token(user)
     return {
         'refresh': str(refresh),
         'access': str(refresh.access_token),
@@ -37,23 +58,12 @@ class GuestUserCreateAPIView(APIView):
         # Instantiate your serializer with empty data as your logic generates it
         serializer = GuestRegistrationSerializer(data={})
         if serializer.is_valid():
-            user, plain_password = serializer.save()  # Unpack the returned tuple
-
-            # Create token manually using the custom serializer with the plain password
-            token_serializer = MyTokenObtainPairSerializer(data={
-                'username': user.username,
-                'password': plain_password  # Use the plain password here
-            })
-
-            # Validate and generate tokens
-            if token_serializer.is_valid():
-                tokens = token_serializer.validated_data
-                return Response({
-                    'tokens': tokens,
-                    'message': 'Guest user created successfully'
-                }, status=status.HTTP_201_CREATED)
-            else:
-                return Response(token_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+            user = serializer.save()
+            # Issue tokens straight from the new user instead of re-authenticating with a password
+            return Response({
+                'tokens': get_tokens_for_user(user),
+                'message': 'Guest user created successfully'
+            }, status=status.HTTP_201_CREATED)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
@@ -67,61 +77,171 @@ class UserDeleteAPIView(APIView):
     def delete(self, request):
         # Directly use request.user since it's always present for authenticated users
         user = request.user
-        user.delete()
+        if request_user_deletion(user):
+            # Large accounts are deleted in the background; the account is already disabled
+            return Response(status=status.HTTP_202_ACCEPTED)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 class ProfilePictureUploadView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request, *args, **kwargs):
-        print("Received request data:", request.data)  # Log the request data
+        logger.debug("Profile picture upload from user %s", request.user.id, extra={'fields': sorted(request.data)})
         user = request.user
         serializer = UserSerializer(user, data=request.data, partial=True)
         if serializer.is_valid():
             serializer.save()
             return Response(serializer.data)
-        print("Serializer errors:", serializer.errors)  # Log serializer errors
+        logger.debug("Rejected profile picture from user %s", user.id, extra={'errors': serializer.errors})
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
 class TaskViewSet(viewsets.ModelViewSet):
     serializer_class = TaskSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = DefaultPagination
     
     def get_queryset(self):
-        return Task.objects.all()
+        # Served by the Task(user, created_at) index
+        return Task.objects.filter(user=self.request.user).order_by('-created_at', '-id')
     
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
     
 class MessageViewSet(viewsets.ModelViewSet):
-    queryset = Message.objects.all()
     serializer_class = MessageSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = DefaultPagination
+
+    def get_queryset(self):
+        # Only messages from sessions the user takes part in
+        return Message.objects.filter(
+            chat_session__participants=self.request.user
+        ).order_by('-timestamp', '-id')
+
+    @action(detail=False)
+    def search(self, request):
+        # /messages/search/?q=<words>: the user's messages containing all the words, best matches first
+        text = request.query_params.get('q', '').strip()
+        if not text:
+            return Response({"q": "Enter words to search for."}, status=status.HTTP_400_BAD_REQUEST)
+        chat_session_ids = ChatSession.participants.through.objects.filter(
+            user_id=request.user.id
+        ).values('chatsession_id')
+        messages = search_messages(Message.objects.filter(chat_session_id__in=chat_session_ids), text)
+        page = self.paginate_queryset(messages)
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+    def perform_destroy(self, instance):
+        instance.delete()
+        # Message deletes send no signal the caches listen to
+        bump_versions([instance.chat_session_id])
+
+    def perform_update(self, serializer):
+        message = serializer.save()
+        # Older clients mark messages read one PATCH at a time; move the read cursor along
+        if serializer.validated_data.get('read') and self.request.user.is_authenticated:
+            try:
+                mark_session_read(self.request.user.id, message.chat_session_id, message.id)
+            except ChatSession.DoesNotExist:
+                pass
 
 class ChatSessionViewSet(viewsets.ModelViewSet):
     queryset = ChatSession.objects.all()
     serializer_class = ChatSessionSerializer
 
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
+    def mark_read(self, request, pk=None):
+        # Marks everything up to "up_to" (default: the latest message) as read in one go
+        up_to = request.data.get('up_to')
+        try:
+            up_to = int(up_to) if up_to is not None else None
+            last_read_message_id, participant_ids = mark_session_read(request.user.id, pk, up_to)
+        except ValueError:
+            return Response({"up_to": "Must be a message id."}, status=status.HTTP_400_BAD_REQUEST)
+        except ChatSession.DoesNotExist:
+            return Response({"message": "No chat session found"}, status=status.HTTP_404_NOT_FOUND)
+
+        text = json.dumps(read_receipt_frame(request.user.id, pk, last_read_message_id))
+        async_to_sync(send_to_users)(
+            get_channel_layer(), participant_ids, text, seqs=append_user_events(participant_ids, text)
+        )
+        return Response({"last_read_message_id": last_read_message_id})
+
     def destroy(self, request, *args, **pk):
         chat_session = self.get_object()
-        messages = Message.objects.filter(chat_session=chat_session)
-        messages.delete()  # Delete all messages associated with the chat session
-        chat_session.delete()  # Delete the chat session
+        # Messages, read cursors and participants go in batches, then the session itself
+        delete_chat_session(chat_session)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+def conditional_get(request, tag, version, build_response):
+    # Answers If-None-Match with a 304 when the version stamp (backend/caching.py) hasn't
+    # moved, without building the response at all. No Last-Modified: in whole seconds it
+    # can't tell apart two versions from the same second, and If-Modified-Since would get
+    # a stale 304.
+    etag = f'W/"{tag}-{version}"'
+    response = get_conditional_response(request._request, etag=etag)
+    if response is None:
+        response = build_response()
+    if response.status_code in (200, 304):
+        response['ETag'] = etag
+    return response
+
 class ChatSessionMessageViewSet(viewsets.ViewSet):
     def retrieve_or_create_session_get_messages(self, request, other_user_id=None):
-        chat_session = get_chat_session(request.user.id, other_user_id)
+        try:
+            chat_session = get_chat_session(request.user.id, other_user_id)
+        except User.DoesNotExist:
+            chat_session = None
         if chat_session:
-            messages = get_messages_for_session(chat_session)
-            serializer = MessageSerializer(messages, many=True)
-            return Response(serializer.data)
+            return conditional_get(
+                request, f"chat-{chat_session.id}", get_version(chat_version_key(chat_session.id)),
+                lambda: self.list_messages(request, chat_session),
+            )
         return Response({"message": "No chat session found"}, status=404)
+
+    def list_messages(self, request, chat_session):
+        messages = get_messages_for_session(chat_session)
+        paginator = MessageKeysetPagination()
+        if paginator.is_requested(request):
+            page = paginator.paginate_queryset(messages, request, view=self)
+            serializer = MessageSerializer(page, many=True)
+            return paginator.get_paginated_response(serializer.data)
+        serializer = MessageSerializer(messages, many=True)
+        return Response(serializer.data)
     
 class UserChatSessionsView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
         user = request.user
-        chat_sessions = ChatSession.objects.filter(participants=user).distinct()
-        serializer = ChatSessionSerializer(chat_sessions, many=True, context={'request': request})
+        return conditional_get(
+            request, f"inbox-{user.id}", get_version(inbox_version_key(user.id)), lambda: self.list_sessions(request)
+        )
+
+    def list_sessions(self, request):
+        chat_sessions = get_inbox_sessions(request.user)
+        serializer = InboxChatSessionSerializer(chat_sessions, many=True, context={'request': request})
         return Response(serializer.data)
 
+
+
+class PresenceView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        # /presence/?ids=1,2,3 -> the subset of those users that is online
+        try:
+            user_ids = [int(user_id) for user_id in request.query_params.get('ids', '').split(',') if user_id]
+        except ValueError:
+            return Response({"ids": "Must be a comma-separated list of user ids."}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({"online": sorted(online_user_ids(user_ids[:MAX_PRESENCE_IDS]))})
+
+def metrics_view(request):
+    # Prometheus scrape target; only served with the METRICS_TOKEN bearer token, from
+    # METRICS_ALLOWED_IPS
+    token = request.META.get('HTTP_AUTHORIZATION', '').removeprefix('Bearer ')
+    if not settings.METRICS_TOKEN or not hmac.compare_digest(token.encode(), settings.METRICS_TOKEN.encode()):
+        raise Http404
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        raise Http404
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,90 @@
+import json
+import zlib
+from urllib.parse import parse_qs
+import msgpack
+from .events import FrameError
+
+# Clients choose how frames are encoded when they connect, either with
+# ?format=msgpack&compress=deflate or, when the token is not itself sent as a subprotocol,
+# with a subprotocol such as "omw.msgpack+deflate". JSON text frames stay the default.
+WIRE_FORMATS = ('json', 'msgpack')
+SUBPROTOCOL_PREFIX = 'omw.'
+# What a sync flush ends with; stripped from each compressed frame as in RFC 7692
+DEFLATE_TRAILER = b'\x00\x00\xff\xff'
+
+
+class WireFormat:
+    """
+    Encodes outgoing frames and decodes incoming ones for one connection.
+    Outgoing frames arrive as JSON text (encoded once for every recipient), so msgpack
+    connections transcode them when they are written. With deflate every frame is binary,
+    and each direction is one raw deflate stream that keeps its window between frames
+    (permessage-deflate with context takeover), so the keys and ids repeated in every
+    frame compress to a few bytes.
+    """
+
+    def __init__(self, name='json', deflate=False):
+        self.name = name
+        self.deflate = deflate
+        if deflate:
+            self.compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+            self.decompressor = zlib.decompressobj(wbits=-zlib.MAX_WBITS)
+
+    @property
+    def subprotocol(self):
+        return f"{SUBPROTOCOL_PREFIX}{self.name}{'+deflate' if self.deflate else ''}"
+
+    def encode(self, text):
+        # Returns the keyword arguments for AsyncWebsocketConsumer.send
+        if self.name == 'msgpack':
+            data = msgpack.packb(json.loads(text))
+        elif self.deflate:
+            data = text.encode()
+        else:
+            return {'text_data': text}
+        if self.deflate:
+            data = (self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH))[:-len(DEFLATE_TRAILER)]
+        return {'bytes_data': data}
+
+    def inflate(self, data, max_size):
+        # Decompresses an incoming frame, refusing to expand it past max_size
+        try:
+            data = self.decompressor.decompress(data + DEFLATE_TRAILER, max_size + 1)
+        except zlib.error:
+            raise FrameError('invalid_encoding')
+        if len(data) > max_size:
+            raise FrameError('frame_too_large')
+        return data
+
+    def loads(self, data):
+        if self.name == 'msgpack':
+            try:
+                return msgpack.unpackb(data)
+            except (ValueError, TypeError, msgpack.UnpackException):
+                raise FrameError('invalid_encoding')
+        return json.loads(data)
+
+
+def parse_subprotocol(subprotocol):
+    # "omw.msgpack+deflate" -> ('msgpack', True); None for anything else
+    if not subprotocol.startswith(SUBPROTOCOL_PREFIX):
+        return None
+    name, _, compression = subprotocol[len(SUBPROTOCOL_PREFIX):].partition('+')
+    if name not in WIRE_FORMATS or compression not in ('', 'deflate'):
+        return None
+    return name, compression == 'deflate'
+
+
+def negotiate(scope):
+    # Returns the connection's WireFormat and the subprotocol to accept for it, if any
+    query = parse_qs(scope.get('query_string', b'').decode())
+    if 'format' in query or 'compress' in query:
+        name = query.get('format', ['json'])[0]
+        return WireFormat(name if name in WIRE_FORMATS else 'json', query.get('compress') == ['deflate']), None
+    # Only one subprotocol can be accepted, and the token's takes precedence
+    if not scope.get('auth_subprotocol'):
+        for subprotocol in scope.get('subprotocols') or []:
+            parsed = parse_subprotocol(subprotocol)
+            if parsed:
+                return WireFormat(*parsed), subprotocol
+    return WireFormat(), None
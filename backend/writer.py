@@ -0,0 +1,135 @@
+import asyncio
+import atexit
+import json
+import logging
+import threading
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from .caching import bump_versions
+from .models import User, Message
+from .utils import append_user_events, get_or_create_direct_session, message_frame
+
+logger = logging.getLogger(__name__)
+
+# Deleted session ids remembered with their replacements
+MAX_MOVED_SESSIONS = 1000
+
+
+class MessageWriter:
+    """
+    Write-behind persistence for chat messages (settings.CHAT_WRITE_BEHIND).
+    Messages are buffered in memory and inserted with bulk_create by a background
+    task once CHAT_WRITE_BEHIND_BATCH_SIZE messages are pending or the oldest one
+    has waited CHAT_WRITE_BEHIND_FLUSH_INTERVAL seconds. Messages carry recipient_id, and
+    each is logged in both users' event streams in the transaction that inserts it.
+    """
+
+    def __init__(self):
+        self.pending = []
+        # Guards self.pending against the atexit flush, which runs outside the event loop
+        self.lock = threading.Lock()
+        self.loop = None
+        self.task = None
+        # {deleted chat session id: the session resolved in its place}
+        self.moved_sessions = {}
+
+    def enqueue(self, message):
+        message.chat_session_id = self.moved_sessions.get(message.chat_session_id, message.chat_session_id)
+        self.ensure_task()
+        with self.lock:
+            self.pending.append(message)
+            pending_count = len(self.pending)
+        self.has_pending.set()
+        if pending_count >= settings.CHAT_WRITE_BEHIND_BATCH_SIZE:
+            self.batch_full.set()
+
+    def ensure_task(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is loop and not self.task.done():
+            return
+        self.loop = loop
+        self.has_pending = asyncio.Event()
+        self.batch_full = asyncio.Event()
+        self.task = loop.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await self.has_pending.wait()
+            try:
+                await asyncio.wait_for(self.batch_full.wait(), settings.CHAT_WRITE_BEHIND_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def take(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if self.loop is not None:
+            self.has_pending.clear()
+            self.batch_full.clear()
+        return batch
+
+    async def flush(self):
+        batch = self.take()
+        if batch:
+            await database_sync_to_async(self.write)(batch)
+
+    def flush_sync(self):
+        self.write(self.take())
+
+    def write(self, batch):
+        if not batch:
+            return
+        try:
+            with transaction.atomic():
+                self.insert(batch)
+        except (DatabaseError, User.DoesNotExist):
+            # One bad row (e.g. a session deleted meanwhile) must not lose the whole batch
+            logger.exception("Batched message insert failed, retrying %d messages one by one", len(batch))
+            for message in batch:
+                message.pk = None
+                try:
+                    with transaction.atomic():
+                        self.insert([message])
+                except (DatabaseError, User.DoesNotExist):
+                    if not self.insert_in_resolved_session(message):
+                        logger.exception("Dropping message from user %s in session %s", message.sender_id, message.chat_session_id)
+
+    def insert(self, messages):
+        Message.objects.bulk_create(messages, batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE)
+        # Logged once they have ids; the broadcast went out without a seq, so clients that
+        # missed it get it replayed, and the rest recognise it by its uuid
+        for message in messages:
+            text = json.dumps(message_frame(message, message.recipient_id))
+            append_user_events([message.sender_id, message.recipient_id], text, message.id)
+        # bulk_create sends no post_save
+        bump_versions({message.chat_session_id for message in messages})
+
+    def insert_in_resolved_session(self, message):
+        # The sender's connection cached a session that has been deleted since: resolve it
+        # again, for this message and for those still on their way with the old id
+        stale_id = message.chat_session_id
+        try:
+            chat_session, created = get_or_create_direct_session(message.sender_id, message.recipient_id)
+        except User.DoesNotExist:
+            return False
+        if chat_session.id == stale_id:
+            return False
+        if len(self.moved_sessions) >= MAX_MOVED_SESSIONS:
+            self.moved_sessions.clear()
+        self.moved_sessions[stale_id] = chat_session.id
+        message.chat_session_id = chat_session.id
+        message.pk = None
+        try:
+            with transaction.atomic():
+                self.insert([message])
+        except (DatabaseError, User.DoesNotExist):
+            return False
+        return True
+
+
+message_writer = MessageWriter()
+
+# Drain whatever is still buffered when the server process shuts down
+atexit.register(message_writer.flush_sync)
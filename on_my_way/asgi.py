@@ -7,9 +7,9 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'on_my_way.settings')
 
 django.setup()
 
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 import backend.routing  # Import the routing of your app
+from backend.auth import JWTAuthMiddleware
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'on_my_way.settings')
 
@@ -17,7 +17,7 @@ django.setup()
 
 application = ProtocolTypeRouter({
   "http": get_asgi_application(),
-  "websocket": AuthMiddlewareStack(
+  "websocket": JWTAuthMiddleware(
         URLRouter(
             backend.routing.websocket_urlpatterns
         )
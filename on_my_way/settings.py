@@ -62,6 +62,7 @@ REST_FRAMEWORK = {
 }
 
 MIDDLEWARE = [
+    'backend.profiling.ProfilingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -123,9 +124,113 @@ SIMPLE_JWT = {
     "SLIDING_TOKEN_REFRESH_LIFETIME": timedelta(days=1),
 }
 
+# The in-memory layer only reaches sockets in the same process. Set REDIS_URL (needs
+# channels_redis) to fan out across Daphne workers; CHANNEL_LAYER=redis-pubsub selects
+# the pub/sub variant. `manage.py fakeredis_server` gives a local stand-in for Redis
+# (use it with CHANNEL_LAYER=redis-pubsub).
+CHANNEL_LAYER_BACKENDS = {
+    "memory": "backend.layers.InMemoryChannelLayer",
+    "redis": "channels_redis.core.RedisChannelLayer",
+    "redis-pubsub": "channels_redis.pubsub.RedisPubSubChannelLayer",
+}
+REDIS_URL = os.environ.get("REDIS_URL")
+CHANNEL_LAYER = os.environ.get("CHANNEL_LAYER", "redis" if REDIS_URL else "memory")
+
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
+        "BACKEND": CHANNEL_LAYER_BACKENDS[CHANNEL_LAYER],
+    },
+}
+if CHANNEL_LAYER != "memory":
+    CHANNEL_LAYERS["default"]["CONFIG"] = {
+        "hosts": [REDIS_URL or "redis://127.0.0.1:6379/0"],
+    }
+
+# Presence (backend/presence.py) lives in the cache, so it is shared between workers
+# when the cache is Redis. Connections refresh their entry every PRESENCE_TTL / 2 seconds.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        # Presence lives in this cache next to profiles and version stamps; culling at the
+        # default 300 entries would keep making connected users look offline
+        "OPTIONS": {"MAX_ENTRIES": 100000},
+    },
+}
+if REDIS_URL:
+    CACHES["default"] = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": REDIS_URL,
+    }
+PRESENCE_TTL = 60
+# User profiles and chat session members (backend/caching.py) are invalidated on change;
+# the TTL only bounds how long an entry missed by a bulk update can live.
+PROFILE_CACHE_TTL = 60 * 60
+
+# User that greets new guest accounts with a welcome message
+WELCOME_BOT_USER_ID = 27
+
+# Write-behind persistence for WebSocket chat messages: broadcast first, then insert
+# in batches of up to CHAT_WRITE_BEHIND_BATCH_SIZE or every FLUSH_INTERVAL seconds.
+# Their frames are broadcast with the message's uuid, before it has an id or a seq; the
+# writer logs them in the event log below once inserted, with both, so they are replayed
+# to clients that missed them and recognised by uuid by those that didn't.
+CHAT_WRITE_BEHIND = False
+CHAT_WRITE_BEHIND_BATCH_SIZE = 100
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = 0.05
+
+# Backpressure on chat WebSockets. Incoming frames over CHAT_MAX_FRAME_BYTES are rejected,
+# and each connection gets token buckets of (frames per second, burst) by event type,
+# 'default' covering the rest. Outgoing frames wait in a queue of CHAT_SEND_QUEUE_SIZE;
+# when a client can't keep up the policy is 'drop_oldest', 'coalesce' (replace stale
+# presence/read receipt frames first) or 'disconnect'.
+CHAT_MAX_FRAME_BYTES = 16 * 1024
+CHAT_RATE_LIMITS = {
+    'message': (5, 20),
+    'heartbeat': (1, 5),
+    'default': (10, 30),
+}
+CHAT_SEND_QUEUE_SIZE = 256
+CHAT_SEND_QUEUE_POLICY = 'coalesce'
+
+# Frames sent to a user carry a per-user "seq" and are kept in an event log. A client
+# reconnecting with ?last_seq=<n> gets the missed frames replayed, or a "resync" frame
+# when more than CHAT_REPLAY_LIMIT are missing or they have been pruned (older than
+# CHAT_EVENT_LOG_RETENTION_DAYS, see `manage.py prune_user_events`).
+CHAT_REPLAY_LIMIT = 500
+CHAT_EVENT_LOG_RETENTION_DAYS = 7
+
+# Users and chat sessions are deleted DELETE_BATCH_SIZE rows at a time (backend/deletion.py).
+# Accounts with more than ACCOUNT_DELETE_BACKGROUND_THRESHOLD sent messages are disabled
+# at once and deleted by a background task.
+DELETE_BATCH_SIZE = 1000
+ACCOUNT_DELETE_BACKGROUND_THRESHOLD = 5000
+
+# Local background workers (backend/tasks.py): a process pool for image processing and a
+# thread pool for database jobs. BACKGROUND_TASKS_EAGER runs tasks inline, e.g. in tests.
+BACKGROUND_TASKS_EAGER = False
+BACKGROUND_PROCESS_WORKERS = 2
+BACKGROUND_THREAD_WORKERS = 4
+
+# Request and WebSocket event timings (backend/profiling.py), served in the Prometheus
+# text format at /metrics/ to scrapers sending "Authorization: Bearer <METRICS_TOKEN>"
+# from METRICS_ALLOWED_IPS; not served at all without a token. The address alone is not
+# enough: behind a reverse proxy on the same host every request comes from 127.0.0.1.
+# Requests and events slower than SLOW_REQUEST_MS are logged with their SQL.
+SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', 500))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_ALLOWED_IPS = os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'verbose': {'format': '{asctime} {levelname} {name} {message}', 'style': '{'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'verbose'},
+    },
+    'loggers': {
+        'backend': {'handlers': ['console'], 'level': os.environ.get('BACKEND_LOG_LEVEL', 'INFO')},
     },
 }
 
@@ -136,12 +241,50 @@ ASGI_APPLICATION = 'on_my_way.asgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DATABASE_ENGINE=postgres (with the POSTGRES_* variables) for production; SQLite otherwise.
+DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'sqlite')
+
+if DATABASE_ENGINE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'on_my_way'),
+            'USER': os.environ.get('POSTGRES_USER', 'on_my_way'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', '127.0.0.1'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # Reused connections are checked before each request instead of failing mid-request
+            'CONN_HEALTH_CHECKS': True,
+            'CONN_MAX_AGE': int(os.environ.get('POSTGRES_CONN_MAX_AGE', 600)),
+        }
     }
-}
+    # POSTGRES_POOL_SIZE > 0 switches from persistent per-thread connections to a shared
+    # psycopg pool (needs psycopg[pool]); Django requires CONN_MAX_AGE = 0 with a pool.
+    POSTGRES_POOL_SIZE = int(os.environ.get('POSTGRES_POOL_SIZE', 0))
+    if POSTGRES_POOL_SIZE:
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS'] = {
+            'pool': {'min_size': 2, 'max_size': POSTGRES_POOL_SIZE, 'timeout': 10},
+        }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+        }
+    }
+    # WAL lets readers carry on while a write is in progress, and synchronous=NORMAL
+    # only fsyncs at checkpoints. "timeout" is SQLite's busy timeout in seconds: writers
+    # wait for the lock instead of failing with "database is locked". IMMEDIATE
+    # transactions take the write lock up front, since a transaction that reads first
+    # and then tries to upgrade its lock gets SQLITE_BUSY without waiting.
+    # SQLITE_TUNED=0 keeps SQLite's defaults (used to compare them in benchmarks).
+    if os.environ.get('SQLITE_TUNED', '1') == '1':
+        DATABASES['default']['OPTIONS'] = {
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL',
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+        }
 
 
 # Password validation